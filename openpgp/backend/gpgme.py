@@ -14,59 +14,92 @@
 # You should have received a copy of the GNU General Public License
 # along with OpenPGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
-
-from nbxmpp.protocol import JID
+import threading
+from pathlib import Path
+from contextlib import contextmanager
 
 import gpg
 from gpg.results import ImportResult
 
-from openpgp.backend.util import parse_uid
+from openpgp.backend.util import KEYRING_FILES
+from openpgp.backend.util import KeyringIndex
+from openpgp.backend.util import KeyringItem
+from openpgp.backend.util import get_keyring_mtime
+from openpgp.backend.util import scan_keyring
 from openpgp.modules.util import DecryptionFailed
 
 log = logging.getLogger('gajim.p.openpgp.gpgme')
 
 
-class KeyringItem:
-    def __init__(self, key):
-        self._key = key
-        self._uid = self._get_uid()
+class ContextPool:
+    '''
+    Holds configured gpg contexts for reuse across operations
+    '''
+    def __init__(self, context_args, size=4):
+        self._context_args = context_args
+        self._size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.created += 1
+
+        log.debug('Create new context (%s created, %s reused)',
+                  self.created, self.reused)
+        return gpg.Context(**self._context_args)
+
+    def _release(self, context):
+        # Only contexts of operations that did not fail are released
+        # here, those are reused as they are
+        with self._lock:
+            if not self._closed and len(self._idle) < self._size:
+                self._idle.append(context)
+                return
+            self.discarded += 1
+
+    def _discard(self, _context):
+        with self._lock:
+            self.discarded += 1
 
-    @property
-    def is_xmpp_key(self) -> bool:
+    @contextmanager
+    def context(self):
+        context = self._acquire()
         try:
-            return self.jid is not None
+            yield context
+        except gpg.errors.KeyNotFound:
+            self._release(context)
+            raise
         except Exception:
-            return False
-
-    def is_valid(self, jid: JID) -> bool:
-        if not self.is_xmpp_key:
-            return False
-        return jid == self.jid
-
-    def _get_uid(self) -> str | None:
-        for uid in self._key.uids:
-            try:
-                return parse_uid(uid.uid)
-            except Exception:
-                pass
-
-    @property
-    def fingerprint(self):
-        return self._key.fpr
-
-    @property
-    def uid(self):
-        if self._uid is not None:
-            return self._uid
-
-    @property
-    def jid(self):
-        if self._uid is not None:
-            return JID.from_string(self._uid)
-
-    def __hash__(self):
-        return hash(self.fingerprint)
+            # The context may be in an undefined state after an error,
+            # a new one is created lazily on the next acquire
+            self._discard(context)
+            raise
+        self._release(context)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'idle': len(self._idle),
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._idle.clear()
 
 
 class GPGME:
@@ -77,9 +110,45 @@ class GPGME:
             'offline': True,
             'armor': False,
         }
+        self._pool = ContextPool(self._context_args)
+
+        self._keyring_paths = [Path(gnuhome) / name for name in KEYRING_FILES]
+        self._key_cache = {}
+        self._key_cache_lock = threading.Lock()
+        self._key_cache_mtime = self.get_keyring_mtime()
+
+        self._index = KeyringIndex(Path(gnuhome) / 'keyring_index.json')
+
+    def get_keyring_mtime(self):
+        return get_keyring_mtime(self._keyring_paths)
+
+    def invalidate_key_cache(self):
+        with self._key_cache_lock:
+            self._key_cache.clear()
+            self._key_cache_mtime = self.get_keyring_mtime()
+
+    def _check_key_cache(self):
+        mtime = self.get_keyring_mtime()
+        with self._key_cache_lock:
+            if mtime != self._key_cache_mtime:
+                log.info('Keyring changed, clear key cache')
+                self._key_cache.clear()
+                self._key_cache_mtime = mtime
+
+    def _get_recipient_key(self, context, fingerprint):
+        with self._key_cache_lock:
+            key = self._key_cache.get(fingerprint)
+        if key is not None:
+            return key
+
+        key = context.get_key(fingerprint)
+        if key is not None:
+            with self._key_cache_lock:
+                self._key_cache[fingerprint] = key
+        return key
 
     def generate_key(self):
-        with gpg.Context(**self._context_args) as context:
+        with self._pool.context() as context:
             result = context.create_key(f'xmpp:{str(self._jid)}',
                                         expires=False,
                                         sign=True,
@@ -90,9 +159,10 @@ class GPGME:
                                         force=False)
 
             log.info('Generated new key: %s', result.fpr)
+        self.invalidate_key_cache()
 
     def get_key(self, fingerprint):
-        with gpg.Context(**self._context_args) as context:
+        with self._pool.context() as context:
             try:
                 key = context.get_key(fingerprint)
             except gpg.errors.KeyNotFound as error:
@@ -106,7 +176,7 @@ class GPGME:
         return key
 
     def get_own_key_details(self):
-        with gpg.Context(**self._context_args) as context:
+        with self._pool.context() as context:
             keys = list(context.keylist(secret=True))
             if not keys:
                 return None, None
@@ -118,22 +188,42 @@ class GPGME:
 
         return None, None
 
-    def get_keys(self):
-        keys = []
-        with gpg.Context(**self._context_args) as context:
-            for key in context.keylist():
-                keyring_item = KeyringItem(key)
-                if not keyring_item.is_xmpp_key:
-                    log.warning('Key not suited for xmpp: %s', key.fpr)
-                    self.delete_key(keyring_item.fingerprint)
-                    continue
+    @staticmethod
+    def _get_keyring_item(key):
+        return KeyringItem.from_uids(key.fpr, [uid.uid for uid in key.uids])
+
+    def is_valid_key(self, fingerprint, jid):
+        key = self.get_key(fingerprint)
+        if key is None:
+            return False
+        return self._get_keyring_item(key).is_valid(jid)
 
-                keys.append(keyring_item)
+    def get_keys(self):
+        return scan_keyring(self._list_keyring,
+                            self.delete_key,
+                            self._index,
+                            self.get_keyring_mtime())
+
+    def _list_keyring(self):
+        with self._pool.context() as context:
+            return [(key.fpr, [uid.uid for uid in key.uids])
+                    for key in context.keylist()]
+
+    def get_key_stamp(self, fingerprint):
+        '''
+        Returns a value that changes whenever the key is modified
+        '''
+        key = self.get_key(fingerprint)
+        if key is None:
+            return None
 
-        return keys
+        parts = [(subkey.fpr, subkey.timestamp, subkey.expires, subkey.revoked)
+                 for subkey in key.subkeys]
+        parts += [uid.uid for uid in key.uids]
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
 
     def export_key(self, fingerprint):
-        with gpg.Context(**self._context_args) as context:
+        with self._pool.context() as context:
             key = context.key_export_minimal(pattern=fingerprint)
         return key
 
@@ -153,16 +243,16 @@ class GPGME:
 
     def encrypt(self, plaintext, keys):
         recipients = []
-        with gpg.Context(**self._context_args) as context:
+        self._check_key_cache()
+        with self._pool.context() as context:
             for key in keys:
-                key = context.get_key(key.fingerprint)
+                key = self._get_recipient_key(context, key.fingerprint)
                 if key is not None:
                     recipients.append(key)
 
-        if not recipients:
-            return None, 'No keys found to encrypt to'
+            if not recipients:
+                return None, 'No keys found to encrypt to'
 
-        with gpg.Context(**self._context_args) as context:
             result = context.encrypt(str(plaintext).encode(),
                                      recipients,
                                      always_trust=True)
@@ -171,11 +261,15 @@ class GPGME:
         return ciphertext, None
 
     def decrypt(self, ciphertext):
-        with gpg.Context(**self._context_args) as context:
-            try:
-                result = context.decrypt(ciphertext)
-            except Exception as error:
-                raise DecryptionFailed('Decryption failed: %s' % error)
+        with self._pool.context() as context:
+            return self._decrypt(context, ciphertext)
+
+    @staticmethod
+    def _decrypt(context, ciphertext):
+        try:
+            result = context.decrypt(ciphertext)
+        except Exception as error:
+            raise DecryptionFailed('Decryption failed: %s' % error)
 
         plaintext, result, verify_result = result
         plaintext = plaintext.decode()
@@ -190,8 +284,9 @@ class GPGME:
 
     def import_key(self, data, jid):
         log.info('Import key from %s', jid)
-        with gpg.Context(**self._context_args) as context:
+        with self._pool.context() as context:
             result = context.key_import(data)
+            self.invalidate_key_cache()
             if not isinstance(result, ImportResult) or result.imported != 1:
                 log.error('Key import failed: %s', jid)
                 log.error(result)
@@ -199,7 +294,7 @@ class GPGME:
 
             fingerprint = result.imports[0].fpr
             key = self.get_key(fingerprint)
-            item = KeyringItem(key)
+            item = self._get_keyring_item(key)
             if not item.is_valid(jid):
                 log.warning('Invalid key found')
                 log.warning(key)
@@ -211,5 +306,10 @@ class GPGME:
     def delete_key(self, fingerprint):
         log.info('Delete Key: %s', fingerprint)
         key = self.get_key(fingerprint)
-        with gpg.Context(**self._context_args) as context:
+        with self._pool.context() as context:
             context.op_delete(key, True)
+        self.invalidate_key_cache()
+
+    def cleanup(self):
+        log.info('Context pool stats: %s', self._pool.get_stats())
+        self._pool.close()
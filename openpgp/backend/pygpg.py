@@ -14,12 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with OpenPGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
+from pathlib import Path
+from functools import partial
 
 import gnupg
-from nbxmpp.protocol import JID
 
-from openpgp.backend.util import parse_uid
+from openpgp.backend.util import KEYRING_FILES
+from openpgp.backend.util import KeyringIndex
+from openpgp.backend.util import KeyringItem
+from openpgp.backend.util import get_keyring_mtime
+from openpgp.backend.util import scan_keyring
 from openpgp.modules.util import DecryptionFailed
 
 
@@ -30,58 +36,18 @@ if log.getEffectiveLevel() == logging.DEBUG:
     log.setLevel(logging.DEBUG)
 
 
-class KeyringItem:
-    def __init__(self, key):
-        self._key = key
-        self._uid = self._get_uid()
-
-    @property
-    def is_xmpp_key(self) -> bool:
-        try:
-            return self.jid is not None
-        except Exception:
-            return False
-
-    def is_valid(self, jid: JID) -> bool:
-        if not self.is_xmpp_key:
-            return False
-        return jid == self.jid
-
-    @property
-    def keyid(self) -> str:
-        return self._key['keyid']
-
-    def _get_uid(self) -> str | None:
-        for uid in self._key['uids']:
-            try:
-                return parse_uid(uid)
-            except Exception:
-                pass
-
-    @property
-    def fingerprint(self):
-        return self._key['fingerprint']
-
-    @property
-    def uid(self):
-        if self._uid is not None:
-            return self._uid
-
-    @property
-    def jid(self):
-        if self._uid is not None:
-            return JID.from_string(self._uid)
-
-    def __hash__(self):
-        return hash(self.fingerprint)
-
-
 class PythonGnuPG(gnupg.GPG):
     def __init__(self, jid, gnupghome):
         gnupg.GPG.__init__(self, gpgbinary='gpg', gnupghome=str(gnupghome))
 
         self._jid = jid.bare
         self._own_fingerprint = None
+        self._keyring_paths = [Path(gnupghome) / name
+                               for name in KEYRING_FILES]
+        self._index = KeyringIndex(Path(gnupghome) / 'keyring_index.json')
+
+    def get_keyring_mtime(self):
+        return get_keyring_mtime(self._keyring_paths)
 
     @staticmethod
     def _get_key_params(jid):
@@ -134,18 +100,27 @@ class PythonGnuPG(gnupg.GPG):
     def get_key(self, fingerprint):
         return super().list_keys(keys=[fingerprint])
 
+    @staticmethod
+    def _get_keyring_item(key):
+        return KeyringItem.from_uids(key['fingerprint'], key['uids'])
+
+    def is_valid_key(self, fingerprint, jid):
+        result = self.get_key(fingerprint)
+        if not result:
+            return False
+        return self._get_keyring_item(result[0]).is_valid(jid)
+
     def get_keys(self, secret=False):
+        # Secret keys are not part of the index
+        index = None if secret else self._index
+        return scan_keyring(partial(self._list_keyring, secret),
+                            self.delete_key,
+                            index,
+                            self.get_keyring_mtime())
+
+    def _list_keyring(self, secret):
         result = super().list_keys(secret=secret)
-        keys = []
-        for key in result:
-            item = KeyringItem(key)
-            if not item.is_xmpp_key:
-                log.warning('Invalid key found, deleting key')
-                log.warning(key)
-                self.delete_key(item.fingerprint)
-                continue
-            keys.append(item)
-        return keys
+        return [(key['fingerprint'], key['uids']) for key in result]
 
     def import_key(self, data, jid):
         log.info('Import key from %s', jid)
@@ -156,7 +131,7 @@ class PythonGnuPG(gnupg.GPG):
             return
 
         key = self.get_key(result.results[0]['fingerprint'])
-        item = KeyringItem(key[0])
+        item = self._get_keyring_item(key[0])
         if not item.is_valid(jid):
             log.warning('Invalid key found, deleting key')
             log.warning(key)
@@ -177,6 +152,20 @@ class PythonGnuPG(gnupg.GPG):
         self._own_fingerprint = result[0]['fingerprint']
         return self._own_fingerprint, int(result[0]['date'])
 
+    def get_key_stamp(self, fingerprint):
+        '''
+        Returns a value that changes whenever the key is modified
+        '''
+        result = self.get_key(fingerprint)
+        if not result:
+            return None
+
+        key = result[0]
+        parts = [key['fingerprint'], key['date'], key['expires'], key['trust']]
+        parts += [subkey for subkey in key['subkeys']]
+        parts += key['uids']
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
     def export_key(self, fingerprint):
         key = super().export_keys(
             fingerprint, secret=False, armor=False, minimal=True)
@@ -185,3 +174,6 @@ class PythonGnuPG(gnupg.GPG):
     def delete_key(self, fingerprint):
         log.info('Delete Key: %s', fingerprint)
         super().delete_keys(fingerprint)
+
+    def cleanup(self):
+        pass
@@ -16,8 +16,11 @@
 
 import sqlite3
 import logging
+from functools import lru_cache
 from collections import namedtuple
 
+from gi.repository import GLib
+
 log = logging.getLogger('gajim.p.openpgp.sql')
 
 TABLE_LAYOUT = '''
@@ -31,24 +34,54 @@ TABLE_LAYOUT = '''
         );
     CREATE UNIQUE INDEX jid_fingerprint ON contacts (jid, fingerprint);'''
 
+MIGRATION_V2 = '''
+    CREATE TABLE publish_state (
+        item TEXT PRIMARY KEY,
+        value TEXT
+        );
+    CREATE TABLE activity (
+        jid TEXT PRIMARY KEY,
+        timestamp INTEGER
+        );
+    CREATE INDEX activity_timestamp ON activity (timestamp);'''
+
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+@lru_cache(maxsize=32)
+def _get_row_type(fields):
+    return namedtuple('Row', fields)
+
 
 class Storage:
-    def __init__(self, folder_path):
+    '''
+    Writes are queued and flushed in one transaction after flush_interval
+    seconds, on reads and on cleanup. A flush_interval of 0 writes through
+    immediately. synchronous sets the sqlite durability level.
+    '''
+    def __init__(self, folder_path, synchronous='FULL', flush_interval=2):
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError('Unknown synchronous mode: %s' % synchronous)
+
         self._con = sqlite3.connect(str(folder_path / 'contacts.db'),
                                     detect_types=sqlite3.PARSE_COLNAMES)
 
         self._con.row_factory = self._namedtuple_factory
         self._create_database()
         self._migrate_database()
-        self._con.execute("PRAGMA synchronous=FULL;")
+        self._con.execute('PRAGMA journal_mode=WAL;')
+        self._con.execute('PRAGMA synchronous=%s;' % synchronous)
         self._con.commit()
 
+        self._flush_interval = flush_interval
+        self._flush_source_id = None
+        self._pending = {}
+        self._pending_activity = {}
+
     @staticmethod
     def _namedtuple_factory(cursor, row):
-        fields = [col[0] for col in cursor.description]
-        Row = namedtuple("Row", fields)
-        named_row = Row(*row)
-        return named_row
+        fields = tuple(col[0] for col in cursor.description)
+        return _get_row_type(fields)._make(row)
 
     def _user_version(self):
         return self._con.execute('PRAGMA user_version').fetchone()[0]
@@ -58,49 +91,135 @@ class Storage:
             log.info('Create contacts.db')
             self._execute_query(TABLE_LAYOUT)
 
-    def _execute_query(self, query):
+    def _execute_query(self, query, version=1):
         transaction = """
             BEGIN TRANSACTION;
             %s
-            PRAGMA user_version=1;
+            PRAGMA user_version=%s;
             END TRANSACTION;
-            """ % (query)
+            """ % (query, version)
         self._con.executescript(transaction)
 
     def _migrate_database(self):
-        pass
+        if self._user_version() < 2:
+            log.info('Migrate contacts.db to version 2')
+            self._execute_query(MIGRATION_V2, 2)
 
-    def load_contacts(self):
+    def load_contact(self, jid):
+        self.flush()
         sql = '''SELECT jid as "jid [jid]",
                         fingerprint,
-                        active, 
+                        active,
                         trust,
                         timestamp,
                         comment
-                FROM contacts'''
+                FROM contacts WHERE jid = ?'''
 
-        return self._con.execute(sql).fetchall()
+        return self._con.execute(sql, (jid,)).fetchall()
 
     def save_contact(self, db_values):
-        sql = '''REPLACE INTO
-                 contacts(jid, fingerprint, active, trust, timestamp, comment)
-                 VALUES(?, ?, ?, ?, ?, ?)'''
         for values in db_values:
             log.info('Store key: %s', values)
-            self._con.execute(sql, values)
-        self._con.commit()
+            self._pending[(values[0], values[1])] = ('replace', values)
+        self._schedule_flush()
 
     def set_trust(self, jid, fingerprint, trust):
-        sql = 'UPDATE contacts SET trust = ? WHERE jid = ? AND fingerprint = ?'
         log.info('Set Trust: %s %s %s', trust, jid, fingerprint)
-        self._con.execute(sql, (trust, jid, fingerprint))
-        self._con.commit()
+        op, values = self._pending.get((jid, fingerprint), (None, None))
+        if op == 'replace':
+            values = values[:3] + (trust,) + values[4:]
+            self._pending[(jid, fingerprint)] = ('replace', values)
+        elif op != 'delete':
+            self._pending[(jid, fingerprint)] = ('trust', trust)
+        self._schedule_flush()
 
     def delete_key(self, jid, fingerprint):
-        sql = 'DELETE from contacts WHERE jid = ? AND fingerprint = ?'
         log.info('Delete Key: %s %s', jid, fingerprint)
-        self._con.execute(sql, (jid, fingerprint))
+        self._pending[(jid, fingerprint)] = ('delete', None)
+        self._schedule_flush()
+
+    def get_publish_state(self, item):
+        sql = 'SELECT value FROM publish_state WHERE item = ?'
+        row = self._con.execute(sql, (item,)).fetchone()
+        if row is None:
+            return None
+        return row.value
+
+    def set_publish_state(self, item, value):
+        log.info('Set publish state: %s %s', item, value)
+        if value is None:
+            sql = 'DELETE FROM publish_state WHERE item = ?'
+            self._con.execute(sql, (item,))
+        else:
+            sql = 'REPLACE INTO publish_state(item, value) VALUES(?, ?)'
+            self._con.execute(sql, (item, value))
         self._con.commit()
 
+    def set_last_activity(self, jid, timestamp):
+        self._pending_activity[jid] = timestamp
+        self._schedule_flush()
+
+    def get_recent_contacts(self, limit):
+        self.flush()
+        sql = '''SELECT jid as "jid [jid]" FROM activity
+                 ORDER BY timestamp DESC LIMIT ?'''
+        return [row.jid for row in self._con.execute(sql, (limit,))]
+
+    def _schedule_flush(self):
+        if not self._flush_interval:
+            self.flush()
+            return
+
+        if self._flush_source_id is None:
+            self._flush_source_id = GLib.timeout_add_seconds(
+                self._flush_interval, self._on_flush_timeout)
+
+    def _on_flush_timeout(self):
+        self._flush_source_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        if self._flush_source_id is not None:
+            GLib.source_remove(self._flush_source_id)
+            self._flush_source_id = None
+
+        if not self._pending and not self._pending_activity:
+            return
+
+        replace = []
+        trust = []
+        delete = []
+        for (jid, fingerprint), (op, values) in self._pending.items():
+            if op == 'replace':
+                replace.append(values)
+            elif op == 'trust':
+                trust.append((values, jid, fingerprint))
+            else:
+                delete.append((jid, fingerprint))
+        self._pending.clear()
+
+        activity = list(self._pending_activity.items())
+        self._pending_activity.clear()
+
+        with self._con:
+            self._con.executemany(
+                '''REPLACE INTO
+                   contacts(jid, fingerprint, active, trust, timestamp,
+                            comment)
+                   VALUES(?, ?, ?, ?, ?, ?)''', replace)
+            self._con.executemany(
+                '''UPDATE contacts SET trust = ?
+                   WHERE jid = ? AND fingerprint = ?''', trust)
+            self._con.executemany(
+                'DELETE from contacts WHERE jid = ? AND fingerprint = ?',
+                delete)
+            self._con.executemany(
+                'REPLACE INTO activity(jid, timestamp) VALUES(?, ?)',
+                activity)
+
+        log.info('Flushed %s changes', len(replace) + len(trust) + len(delete))
+
     def cleanup(self):
+        self.flush()
         self._con.close()
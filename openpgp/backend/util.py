@@ -1,6 +1,17 @@
 
 from __future__ import annotations
 
+import json
+import logging
+import threading
+import zlib
+
+from nbxmpp.protocol import JID
+
+log = logging.getLogger('gajim.p.openpgp.util')
+
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg')
+
 
 def parse_uid(uid: str, compat=False) -> str:
     if uid.startswith('xmpp:'):
@@ -11,3 +22,189 @@ def parse_uid(uid: str, compat=False) -> str:
         return uid[:-1].split('<xmpp:', maxsplit=1)[1]
 
     raise ValueError('Uknown UID format: %s' % uid)
+
+
+_UNSET = object()
+
+
+class KeyringItem:
+    '''
+    Immutable record of a key in the keyring, the XMPP uid is parsed once
+    on creation and the JID once on first access
+    '''
+
+    __slots__ = ('fingerprint', 'uid', '_jid')
+
+    def __init__(self, fingerprint: str, uid: str | None, jid=_UNSET) -> None:
+        object.__setattr__(self, 'fingerprint', fingerprint)
+        object.__setattr__(self, 'uid', uid)
+        object.__setattr__(self, '_jid', jid)
+
+    @classmethod
+    def from_uids(cls, fingerprint: str, uids: list[str]) -> KeyringItem:
+        uid = cls._find_uid(uids)
+        if uid is None:
+            return cls(fingerprint, None, None)
+        return cls(fingerprint, uid)
+
+    @classmethod
+    def from_keylist(cls, keylist) -> list[KeyringItem]:
+        '''
+        Creates items from (fingerprint, uids) pairs, JIDs shared by
+        several keys are only parsed once
+        '''
+        jids = {}
+        items = []
+        for fingerprint, uids in keylist:
+            uid = cls._find_uid(uids)
+            if uid is None:
+                items.append(cls(fingerprint, None, None))
+                continue
+
+            if uid not in jids:
+                jids[uid] = cls._parse_jid(uid)
+            items.append(cls(fingerprint, uid, jids[uid]))
+        return items
+
+    @staticmethod
+    def _find_uid(uids: list[str]) -> str | None:
+        for uid in uids:
+            try:
+                return parse_uid(uid)
+            except Exception:
+                pass
+        return None
+
+    @staticmethod
+    def _parse_jid(uid: str) -> JID | None:
+        try:
+            return JID.from_string(uid)
+        except Exception:
+            return None
+
+    def __setattr__(self, name, value):
+        raise AttributeError('KeyringItem is immutable')
+
+    @property
+    def jid(self) -> JID | None:
+        if self._jid is _UNSET:
+            object.__setattr__(self, '_jid', self._parse_jid(self.uid))
+        return self._jid
+
+    @property
+    def is_xmpp_key(self) -> bool:
+        return self.jid is not None
+
+    def is_valid(self, jid: JID) -> bool:
+        if not self.is_xmpp_key:
+            return False
+        return jid == self.jid
+
+    def __eq__(self, other):
+        if not isinstance(other, KeyringItem):
+            return NotImplemented
+        return self.fingerprint == other.fingerprint
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+
+def get_uid_stamp(uids: list[str]) -> int:
+    return zlib.crc32('\n'.join(uids).encode())
+
+
+class KeyringIndex:
+    '''
+    Persisted index of the keyring, maps fingerprint -> (uid, stamp)
+    '''
+    def __init__(self, path):
+        self._path = path
+        self.mtime = None
+        self.keys = {}
+        self._load()
+
+    def _load(self):
+        try:
+            data = json.loads(self._path.read_text())
+        except FileNotFoundError:
+            return
+        except Exception as error:
+            log.warning('Could not load keyring index: %s', error)
+            return
+
+        self.mtime = data['mtime']
+        self.keys = {fingerprint: tuple(value)
+                     for fingerprint, value in data['keys'].items()}
+
+    def store(self, mtime, keys):
+        self.mtime = mtime
+        self.keys = keys
+
+        temp_path = self._path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps({'mtime': mtime, 'keys': keys}))
+        temp_path.replace(self._path)
+
+
+def get_keyring_mtime(paths) -> int:
+    mtime = 0
+    for path in paths:
+        try:
+            mtime = max(mtime, path.stat().st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    return mtime
+
+
+def scan_keyring(list_keys, delete_key, index=None, mtime=None):
+    '''
+    Returns the keys suited for XMPP. list_keys returns (fingerprint, uids)
+    pairs of all keys, with an index only keys whose uids changed since
+    the last scan are parsed again. Keys not suited for XMPP are deleted
+    with delete_key in the background.
+    '''
+    if index is not None and mtime == index.mtime:
+        return [KeyringItem(fingerprint, uid)
+                for fingerprint, (uid, _stamp) in index.keys.items()]
+
+    indexed_keys = index.keys if index is not None else {}
+    keys = []
+    new_index = {}
+    invalid = []
+    stamps = {}
+    keylist = []
+    for fingerprint, uids in list_keys():
+        stamp = get_uid_stamp(uids)
+        indexed = indexed_keys.get(fingerprint)
+        if indexed is not None and indexed[1] == stamp:
+            keys.append(KeyringItem(fingerprint, indexed[0]))
+            new_index[fingerprint] = indexed
+            continue
+
+        stamps[fingerprint] = stamp
+        keylist.append((fingerprint, uids))
+
+    for item in KeyringItem.from_keylist(keylist):
+        if not item.is_xmpp_key:
+            log.warning('Key not suited for xmpp: %s', item.fingerprint)
+            invalid.append(item.fingerprint)
+            continue
+
+        keys.append(item)
+        new_index[item.fingerprint] = (item.uid, stamps[item.fingerprint])
+
+    log.info('Keyring scan: %s keys, %s rescanned', len(keys), len(keylist))
+    if index is not None:
+        index.store(mtime, new_index)
+
+    if invalid:
+        # Deleting keys is slow, do it in the background
+        thread = threading.Thread(target=_delete_keys,
+                                  args=(delete_key, invalid),
+                                  daemon=True)
+        thread.start()
+    return keys
+
+
+def _delete_keys(delete_key, fingerprints):
+    for fingerprint in fingerprints:
+        delete_key(fingerprint)
@@ -25,6 +25,15 @@ class KeyData:
     '''
     Holds all data related to a certain key
     '''
+
+    __slots__ = ('_contact_data',
+                 'fingerprint',
+                 'active',
+                 '_trust',
+                 'timestamp',
+                 'comment',
+                 'has_pubkey')
+
     def __init__(self, contact_data):
         self._contact_data = contact_data
         self.fingerprint = None
@@ -32,7 +41,8 @@ class KeyData:
         self._trust = Trust.UNKNOWN
         self.timestamp = None
         self.comment = None
-        self.has_pubkey = False
+        # None until checked against the keyring
+        self.has_pubkey = None
 
     @property
     def trust(self):
@@ -75,11 +85,15 @@ class ContactData:
     '''
     Holds all data related to a contact
     '''
+
+    __slots__ = ('jid', '_key_store', '_storage', '_pgp', '_last_keylist')
+
     def __init__(self, jid, storage, pgp):
         self.jid = jid
         self._key_store = {}
         self._storage = storage
         self._pgp = pgp
+        self._last_keylist = None
 
     @property
     def userid(self):
@@ -94,8 +108,10 @@ class ContactData:
                 return Trust.UNKNOWN
         return Trust.BLIND
 
-    def db_values(self):
-        for key in self._key_store.values():
+    def db_values(self, keys=None):
+        if keys is None:
+            keys = self._key_store.values()
+        for key in keys:
             yield (self.jid,
                    key.fingerprint,
                    key.active,
@@ -125,36 +141,49 @@ class ContactData:
         log.info('Process keylist: %s %s', self.jid, keylist)
 
         if keylist is None:
-            for keydata in self._key_store.values():
-                keydata.active = False
-            self._storage.save_contact(self.db_values())
-            return []
+            keylist = []
+
+        # A fingerprint may be listed more than once
+        keys = {key.fingerprint: key for key in keylist}
+        fingerprints = frozenset(keys)
+        if fingerprints == self._last_keylist:
+            log.info('Keylist unchanged: %s', self.jid)
+            return self._get_missing_pub_keys(fingerprints)
 
+        changed = []
+        added = fingerprints - self._key_store.keys()
+        for fingerprint, keydata in self._key_store.items():
+            active = fingerprint in fingerprints
+            if keydata.active != active:
+                keydata.active = active
+                changed.append(keydata)
+
+        for fingerprint, key in keys.items():
+            if fingerprint in added:
+                changed.append(self.add_from_key(key))
+
+        log.info('Keylist diff: %s added, %s changed',
+                 len(added), len(changed) - len(added))
+
+        if changed:
+            self._storage.save_contact(self.db_values(changed))
+
+        self._last_keylist = fingerprints
+        return self._get_missing_pub_keys(fingerprints)
+
+    def _get_missing_pub_keys(self, fingerprints):
         missing_pub_keys = []
-        fingerprints = set([key.fingerprint for key in keylist])
-        if fingerprints == self._key_store.keys():
-            log.info('No updates found')
-            for key in self._key_store.values():
-                if not key.has_pubkey:
-                    missing_pub_keys.append(key.fingerprint)
-            return missing_pub_keys
-
-        for keydata in self._key_store.values():
-            keydata.active = False
-
-        for key in keylist:
-            try:
-                keydata = self._key_store[key.fingerprint]
-                keydata.active = True
-                if not keydata.has_pubkey:
-                    missing_pub_keys.append(keydata.fingerprint)
-            except KeyError:
-                keydata = self.add_from_key(key)
-                missing_pub_keys.append(keydata.fingerprint)
-
-        self._storage.save_contact(self.db_values())
+        for fingerprint in fingerprints:
+            if not self._has_pubkey(self._key_store[fingerprint]):
+                missing_pub_keys.append(fingerprint)
         return missing_pub_keys
 
+    def _has_pubkey(self, keydata):
+        if keydata.has_pubkey is None:
+            keydata.has_pubkey = self._pgp.is_valid_key(keydata.fingerprint,
+                                                        self.jid)
+        return keydata.has_pubkey
+
     def set_public_key(self, fingerprint):
         try:
             keydata = self._key_store[fingerprint]
@@ -182,6 +211,7 @@ class ContactData:
         self._storage.delete_key(self.jid, fingerprint)
         self._pgp.delete_key(fingerprint)
         del self._key_store[fingerprint]
+        self._last_keylist = None
 
 
 class PGPContacts:
@@ -192,65 +222,33 @@ class PGPContacts:
         self._contacts = {}
         self._storage = storage
         self._pgp = pgp
-        self._load_from_storage()
-        self._load_from_keyring()
-
-    def _load_from_keyring(self):
-        log.info('Load keys from keyring')
-        keyring = self._pgp.get_keys()
-        for key in keyring:
-            log.info('Found: %s %s', key.jid, key.fingerprint)
-            self.set_public_key(key.jid, key.fingerprint)
-
-    def _load_from_storage(self):
-        log.info('Load contacts from storage')
-        rows = self._storage.load_contacts()
-        if rows is None:
-            return
-
-        for row in rows:
-            log.info('Found: %s %s', row.jid, row.fingerprint)
-            try:
-                contact_data = self._contacts[row.jid]
-            except KeyError:
-                contact_data = ContactData(row.jid, self._storage, self._pgp)
-                contact_data.add_from_db(row)
-                self._contacts[row.jid] = contact_data
-            else:
-                contact_data.add_from_db(row)
 
-    def process_keylist(self, jid, keylist):
+    def _get_contact(self, jid):
         try:
-            contact_data = self._contacts[jid]
+            return self._contacts[jid]
         except KeyError:
-            contact_data = ContactData(jid, self._storage, self._pgp)
-            missing_pub_keys = contact_data.process_keylist(keylist)
-            self._contacts[jid] = contact_data
-        else:
-            missing_pub_keys = contact_data.process_keylist(keylist)
+            pass
 
-        return missing_pub_keys
+        contact_data = ContactData(jid, self._storage, self._pgp)
+        for row in self._storage.load_contact(jid):
+            contact_data.add_from_db(row)
+        self._contacts[jid] = contact_data
+        return contact_data
+
+    def process_keylist(self, jid, keylist):
+        contact_data = self._get_contact(jid)
+        return contact_data.process_keylist(keylist)
 
     def set_public_key(self, jid, fingerprint):
-        try:
-            contact_data = self._contacts[jid]
-        except KeyError:
-            log.warning('ContactData not found: %s %s', jid, fingerprint)
-        else:
-            contact_data.set_public_key(fingerprint)
+        contact_data = self._get_contact(jid)
+        contact_data.set_public_key(fingerprint)
 
     def get_keys(self, jid, only_trusted=True):
-        try:
-            contact_data = self._contacts[jid]
-            return contact_data.get_keys(only_trusted=only_trusted)
-        except KeyError:
-            return []
+        contact_data = self._get_contact(jid)
+        return contact_data.get_keys(only_trusted=only_trusted)
 
     def get_trust(self, jid, fingerprint):
-        contact_data = self._contacts.get(jid, None)
-        if contact_data is None:
-            return Trust.UNKNOWN
-
+        contact_data = self._get_contact(jid)
         key = contact_data.get_key(fingerprint)
         if key is None:
             return Trust.UNKNOWN
@@ -16,12 +16,18 @@
 
 import sys
 import time
+import hashlib
 import logging
+import threading
+from collections import deque
 from pathlib import Path
+from functools import partial
 
+from gi.repository import GLib
 from nbxmpp.namespaces import Namespace
 from nbxmpp import Node
 from nbxmpp import StanzaMalformed
+from nbxmpp.protocol import NodeProcessed
 from nbxmpp.structs import StanzaHandler
 from nbxmpp.errors import StanzaError
 from nbxmpp.errors import MalformedStanzaError
@@ -44,8 +50,13 @@ from openpgp.modules.util import Trust
 from openpgp.modules.util import add_additional_data
 from openpgp.modules.util import DecryptionFailed
 from openpgp.modules.util import prepare_stanza
+from openpgp.modules.util import get_message_handlers
 from openpgp.modules.key_store import PGPContacts
+from openpgp.modules.pipeline import DecryptionPipeline
+from openpgp.modules.pipeline import EncryptionQueue
+from openpgp.modules.pipeline import resume_handlers
 from openpgp.backend.sql import Storage
+from openpgp.backend.sql import SYNCHRONOUS_MODES
 
 if sys.platform == 'win32':
     from openpgp.backend.pygpg import PythonGnuPG as PGPBackend
@@ -60,6 +71,15 @@ log = logging.getLogger('gajim.p.openpgp')
 name = ENCRYPTION_NAME
 zeroconf = False
 
+DECRYPT_PRIORITY = 9
+
+MAX_KEY_REQUESTS = 5
+KEY_REQUEST_BACKOFF = 60
+KEY_REQUEST_MAX_BACKOFF = 3600
+
+PREFETCH_LIMIT = 50
+PREFETCH_INTERVAL = 500
+
 
 class OpenPGP(BaseModule):
 
@@ -80,7 +100,7 @@ class OpenPGP(BaseModule):
             StanzaHandler(name='message',
                           callback=self.decrypt_message,
                           ns=Namespace.OPENPGP,
-                          priority=9),
+                          priority=DECRYPT_PRIORITY),
         ]
 
         self._register_pubsub_handler(self._keylist_notification_received)
@@ -92,12 +112,46 @@ class OpenPGP(BaseModule):
         if not path.exists():
             path.mkdir(mode=0o700, parents=True)
 
+        self._path = path
         self._pgp = PGPBackend(self.own_jid, path)
-        self._storage = Storage(path)
+        self._storage = Storage(path, **self._get_storage_config())
         self._contacts = PGPContacts(self._pgp, self._storage)
+        self._decryption = DecryptionPipeline(self._pgp.decrypt,
+                                              self._on_message_decrypted)
+        self._encryption = EncryptionQueue()
+
+        self._key_requests = set()
+        self._queued_key_requests = {}
+        self._failed_key_requests = {}
+
+        self._prefetch_queue = deque()
+        self._prefetch_source_id = None
         self._fingerprint, self._date = self.get_own_key_details()
         log.info('Own Fingerprint at start: %s', self._fingerprint)
 
+        # Contacts are loaded on first access, the keyring is only
+        # scanned to remove keys not suited for XMPP. Listing the keys
+        # runs gpg, so it is done off the main loop.
+        thread = threading.Thread(target=self._cleanup_keyring,
+                                  args=(self._pgp,),
+                                  daemon=True)
+        thread.start()
+
+    @staticmethod
+    def _get_storage_config():
+        for plugin in app.plugin_manager.plugins:
+            if plugin.manifest.short_name != 'openpgp':
+                continue
+
+            synchronous = str(plugin.config['synchronous']).upper()
+            if synchronous not in SYNCHRONOUS_MODES:
+                log.warning('Unknown synchronous mode %s, use FULL',
+                            synchronous)
+                synchronous = 'FULL'
+            return {'synchronous': synchronous,
+                    'flush_interval': plugin.config['flush_interval']}
+        return {}
+
     @property
     def secret_key_available(self):
         return self._fingerprint is not None
@@ -109,33 +163,178 @@ class OpenPGP(BaseModule):
     def generate_key(self):
         self._pgp.generate_key()
 
-    def set_public_key(self):
+    def _cleanup_keyring(self, pgp):
+        keys = pgp.get_keys()
+        log.info('%s => Keyring contains %s keys', self._account, len(keys))
+
+    def sync(self):
+        '''
+        Make sure keylist and public key are published and prefetch the
+        keylists of recently active contacts
+        '''
+        self.request_keylist()
+        self.set_public_key(force=False)
+        self._prefetch_keylists()
+
+    def set_public_key(self, force=True):
+        key = self._get_public_key_export()
+        key_hash = hashlib.sha256(key).hexdigest()
+        if not force and key_hash == self._storage.get_publish_state('key'):
+            log.info('%s => Public key unchanged, skip publish', self._account)
+            return
+
         log.info('%s => Publish public key', self._account)
-        key = self._pgp.export_key(self._fingerprint)
         self._nbxmpp('OpenPGP').set_public_key(
-            key, self._fingerprint, self._date)
+            key,
+            self._fingerprint,
+            self._date,
+            callback=self._public_key_published,
+            user_data=key_hash)
+
+    def _public_key_published(self, task):
+        if self._pgp is None:
+            return
+
+        try:
+            task.finish()
+        except (StanzaError, MalformedStanzaError) as error:
+            log.error('%s => Publishing public key failed: %s',
+                      self._account, error)
+            return
+
+        # Only a key the server accepted is skipped on the next sync
+        self._storage.set_publish_state('key', task.get_user_data())
+
+    def _get_public_key_export(self):
+        # The minimal export is cached on disk, the cache is checked
+        # against the keyring mtime and if the keyring changed, against
+        # the stamp of our own key
+        cache_path = self._path / ('%s.pub' % self._fingerprint)
+        keyring_mtime = self._pgp.get_keyring_mtime()
+
+        state = self._storage.get_publish_state('export')
+        if state is not None:
+            fingerprint, stamp, mtime = state.split()
+            if fingerprint == self._fingerprint and cache_path.exists():
+                if int(mtime) == keyring_mtime:
+                    return cache_path.read_bytes()
+
+                if stamp == self._pgp.get_key_stamp(self._fingerprint):
+                    self._storage.set_publish_state(
+                        'export', '%s %s %s' % (fingerprint,
+                                                stamp,
+                                                keyring_mtime))
+                    return cache_path.read_bytes()
+
+            if fingerprint != self._fingerprint:
+                old_path = self._path / ('%s.pub' % fingerprint)
+                old_path.unlink(missing_ok=True)
+
+        log.info('%s => Export public key', self._account)
+        key = self._pgp.export_key(self._fingerprint)
+        stamp = self._pgp.get_key_stamp(self._fingerprint)
+        if not key or stamp is None:
+            return key
+
+        temp_path = cache_path.with_suffix('.tmp')
+        temp_path.write_bytes(key)
+        temp_path.replace(cache_path)
+        self._storage.set_publish_state(
+            'export', '%s %s %s' % (self._fingerprint, stamp, keyring_mtime))
+        return key
+
+    def _prefetch_keylists(self):
+        self._prefetch_queue.clear()
+        for jid in self._storage.get_recent_contacts(PREFETCH_LIMIT):
+            if not self.own_jid.bare_match(jid):
+                self._prefetch_queue.append(jid)
+
+        if self._prefetch_queue and self._prefetch_source_id is None:
+            self._prefetch_source_id = GLib.timeout_add(
+                PREFETCH_INTERVAL, self._prefetch_next_keylist)
+
+    def _prefetch_next_keylist(self):
+        if not self._prefetch_queue or not self._client.state.is_available:
+            self._prefetch_queue.clear()
+            self._prefetch_source_id = None
+            return False
+
+        self.request_keylist(self._prefetch_queue.popleft())
+        return True
 
     def request_public_key(self, jid, fingerprint):
+        request = (jid, fingerprint)
+        if (request in self._key_requests or
+                request in self._queued_key_requests):
+            log.info('%s => Public key request already pending %s - %s',
+                     self._account, fingerprint, jid)
+            return
+
+        failure = self._failed_key_requests.get(request)
+        if failure is not None and time.monotonic() < failure[1]:
+            log.info('%s => Public key request failed recently, '
+                     'skip %s - %s', self._account, fingerprint, jid)
+            return
+
+        if len(self._key_requests) >= MAX_KEY_REQUESTS:
+            self._queued_key_requests[request] = None
+            return
+
+        self._send_public_key_request(request)
+
+    def reset_key_requests(self):
+        '''
+        Forget requests of the previous connection, their responses
+        are never delivered
+        '''
+        self._key_requests.clear()
+        self._queued_key_requests.clear()
+
+    def _send_public_key_request(self, request):
+        jid, fingerprint = request
         log.info('%s => Request public key %s - %s',
                  self._account, fingerprint, jid)
+        self._key_requests.add(request)
         self._nbxmpp('OpenPGP').request_public_key(
             jid,
             fingerprint,
             callback=self._public_key_received,
-            user_data=fingerprint)
+            user_data=request)
 
     def _public_key_received(self, task):
-        fingerprint = task.get_user_data()
+        request = task.get_user_data()
+        _jid, fingerprint = request
+        if self._pgp is None:
+            return
+
+        self._key_requests.discard(request)
+        if self._queued_key_requests:
+            next_request = next(iter(self._queued_key_requests))
+            del self._queued_key_requests[next_request]
+            self._send_public_key_request(next_request)
+
         try:
             result = task.finish()
         except (StanzaError, MalformedStanzaError) as error:
             log.error('%s => Public Key not found: %s',
                       self._account, error)
+            self._add_failed_key_request(request)
             return
 
         imported_key = self._pgp.import_key(result.key, result.jid)
-        if imported_key is not None:
-            self._contacts.set_public_key(result.jid, fingerprint)
+        if imported_key is None:
+            self._add_failed_key_request(request)
+            return
+
+        self._failed_key_requests.pop(request, None)
+        self._contacts.set_public_key(result.jid, fingerprint)
+
+    def _add_failed_key_request(self, request):
+        attempts, _retry_at = self._failed_key_requests.get(request, (0, 0))
+        backoff = min(KEY_REQUEST_BACKOFF * 2 ** attempts,
+                      KEY_REQUEST_MAX_BACKOFF)
+        self._failed_key_requests[request] = (attempts + 1,
+                                              time.monotonic() + backoff)
 
     def set_keylist(self, keylist=None):
         if keylist is None:
@@ -170,7 +369,9 @@ class OpenPGP(BaseModule):
             log.error('%s => Keylist query failed: %s',
                       self._account, error)
             if self.own_jid.bare_match(jid) and self._fingerprint is not None:
+                # Our published data is gone, publish everything again
                 self.set_keylist()
+                self.set_public_key()
             return
 
         log.info('Keylist received from %s', jid)
@@ -208,16 +409,55 @@ class OpenPGP(BaseModule):
         for fingerprint in missing_pub_keys:
             self.request_public_key(from_jid, fingerprint)
 
-    def decrypt_message(self, _con, stanza, properties):
+    def decrypt_message(self, con, stanza, properties):
         if not properties.is_openpgp:
             return
 
-        try:
-            payload, fingerprint = self._pgp.decrypt(properties.openpgp)
-        except DecryptionFailed as error:
-            log.warning(error)
+        if properties.is_mam_message:
+            # The MAM query result is not encrypted and is handed to its
+            # IQ callback by nbxmpp before any stanza handler runs, so it
+            # can not be held back until the pipeline drained. Gajim drops
+            # archived messages of a finished query, so they are decrypted
+            # here, one by one, before the next stanza is dispatched.
+            result = self._decryption.decrypt(properties.openpgp)
+            self._on_message_decrypted(result, con, stanza, properties)
+            raise NodeProcessed
+
+        # Decryption happens off the main loop, the remaining handlers
+        # are run once the result is delivered
+        self._decryption.submit(properties.openpgp, con, stanza, properties)
+        raise NodeProcessed
+
+    def _on_message_decrypted(self, result, con, stanza, properties):
+        if self._pgp is None:
             return
 
+        if con is not self._client.connection:
+            # The stream was closed meanwhile, the message is fetched
+            # again with the MAM catch up after reconnect
+            log.info('%s => Connection changed, drop decrypted message',
+                     self._account)
+            return
+
+        if isinstance(result, DecryptionFailed):
+            log.warning(result)
+        elif isinstance(result, Exception):
+            log.error('Error while decrypting message: %s', result)
+        else:
+            payload, fingerprint = result
+            self._process_decrypted_message(
+                stanza, properties, payload, fingerprint)
+
+        # The message is handled further even if decryption failed,
+        # so the user sees the fallback body
+        resume_handlers(con,
+                        get_message_handlers(self._client),
+                        stanza,
+                        properties,
+                        DECRYPT_PRIORITY)
+
+    def _process_decrypted_message(self, stanza, properties,
+                                   payload, fingerprint):
         signcrypt = Node(node=payload)
 
         try:
@@ -241,6 +481,7 @@ class OpenPGP(BaseModule):
 
         log.info('Received OpenPGP message from: %s', properties.jid)
         prepare_stanza(stanza, payload)
+        self._storage.set_last_activity(properties.jid.bare, int(time.time()))
 
         trust = self._contacts.get_trust(properties.jid.bare, fingerprint)
 
@@ -261,7 +502,20 @@ class OpenPGP(BaseModule):
                                         [obj.jid],
                                         NOT_ENCRYPTED_TAGS)
 
-        encrypted_payload, error = self._pgp.encrypt(payload, keys)
+        # Encrypt off the main loop, messages to the same contact
+        # are encrypted and sent in order
+        self._encryption.submit(str(obj.jid),
+                                self._pgp.encrypt,
+                                (str(payload), keys),
+                                partial(self._on_message_encrypted,
+                                        obj,
+                                        callback))
+
+    def _on_message_encrypted(self, obj, callback, result):
+        if self._pgp is None:
+            return
+
+        encrypted_payload, error = result
         if error:
             log.error('Error: %s', error)
             app.ged.raise_event(
@@ -280,6 +534,7 @@ class OpenPGP(BaseModule):
         obj.additional_data['encrypted'] = {
             'name': ENCRYPTION_NAME,
             'trust': Trust.VERIFIED}
+        self._storage.set_last_activity(str(obj.jid), int(time.time()))
         callback(obj)
 
     @staticmethod
@@ -300,7 +555,12 @@ class OpenPGP(BaseModule):
         self.set_keylist()
 
     def cleanup(self):
+        if self._prefetch_source_id is not None:
+            GLib.source_remove(self._prefetch_source_id)
+        self._decryption.shutdown()
+        self._encryption.shutdown()
         self._storage.cleanup()
+        self._pgp.cleanup()
         self._pgp = None
         self._contacts = None
 
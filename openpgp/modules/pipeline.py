@@ -0,0 +1,241 @@
+# This file is part of the OpenPGP Gajim Plugin.
+#
+# OpenPGP Gajim Plugin is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; version 3 only.
+#
+# OpenPGP Gajim Plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OpenPGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from gi.repository import GLib
+from nbxmpp.namespaces import Namespace
+from nbxmpp.protocol import NodeProcessed
+
+log = logging.getLogger('gajim.p.openpgp.pipeline')
+
+# Throughput of synchronous decryption is logged every n messages
+SYNC_REPORT_INTERVAL = 100
+
+
+def _get_specific(handler):
+    typ = handler.typ
+    if not typ and not handler.ns:
+        typ = 'default'
+    return typ + handler.ns
+
+
+def build_handler_chain(handlers, stanza, priority):
+    '''
+    Builds the chain of handlers the way nbxmpp does, from the properties
+    of the decrypted stanza and only with handlers after the given priority
+    '''
+    xmlns = stanza.getNamespace() or Namespace.CLIENT
+    typ = stanza.getType() or 'normal'
+    props = stanza.getProperties()
+
+    specifics = {'default', typ}
+    for prop in props:
+        specifics.add(prop)
+        specifics.add(typ + prop)
+
+    chain = [handler for handler in handlers
+             if handler.priority > priority and
+             (handler.xmlns or Namespace.CLIENT) == xmlns and
+             _get_specific(handler) in specifics]
+    chain.sort(key=lambda handler: handler.priority)
+    return chain
+
+
+def resume_handlers(con, handlers, stanza, properties, priority):
+    '''
+    Runs the message handlers which come after the handler with the
+    given priority
+    '''
+    for handler in build_handler_chain(handlers, stanza, priority):
+        try:
+            handler.callback(con, stanza, properties)
+        except NodeProcessed:
+            return
+        except Exception:
+            log.exception('Handler exception:')
+            return
+
+
+class DecryptionPipeline:
+    '''
+    Decrypts messages on worker threads and hands the results back to
+    the main loop in the order the messages arrived. decrypt() runs on
+    the calling thread for messages which can not wait.
+    '''
+    def __init__(self, decrypt_func, deliver_func, max_workers=2):
+        self._decrypt_func = decrypt_func
+        self._deliver_func = deliver_func
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='openpgp-decrypt')
+
+        self._next_seq = 0
+        self._deliver_seq = 0
+        self._finished = {}
+        self._closed = False
+
+        self.processed = 0
+        self.wait_time = 0.0
+        self.decrypt_time = 0.0
+        self.reorder_time = 0.0
+
+        self.sync_processed = 0
+        self.sync_time = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._next_seq - self._deliver_seq
+
+    def submit(self, ciphertext, *args):
+        seq = self._next_seq
+        self._next_seq += 1
+        future = self._executor.submit(self._run,
+                                       ciphertext,
+                                       time.monotonic())
+        future.add_done_callback(partial(self._on_done, seq, args))
+
+    def decrypt(self, ciphertext):
+        started = time.monotonic()
+        try:
+            result = self._decrypt_func(ciphertext)
+        except Exception as error:
+            result = error
+
+        self.sync_processed += 1
+        self.sync_time += time.monotonic() - started
+        if self.sync_processed % SYNC_REPORT_INTERVAL == 0:
+            log.info('Decrypted %s messages synchronously (%.1f msg/s)',
+                     self.sync_processed, self.sync_rate)
+        return result
+
+    @property
+    def sync_rate(self):
+        return self.sync_processed / (self.sync_time or 1e-6)
+
+    def _run(self, ciphertext, submitted):
+        started = time.monotonic()
+        try:
+            result = self._decrypt_func(ciphertext)
+        except Exception as error:
+            result = error
+        return result, started - submitted, time.monotonic() - started
+
+    def _on_done(self, seq, args, future):
+        # Called on the worker thread
+        if future.cancelled():
+            return
+        GLib.idle_add(self._finish, seq, args, future.result())
+
+    def _finish(self, seq, args, outcome):
+        if self._closed:
+            return False
+
+        result, wait_time, decrypt_time = outcome
+        self.wait_time += wait_time
+        self.decrypt_time += decrypt_time
+        self._finished[seq] = (args, result, time.monotonic())
+
+        while self._deliver_seq in self._finished:
+            args, result, finished = self._finished.pop(self._deliver_seq)
+            self._deliver_seq += 1
+            self.processed += 1
+            self.reorder_time += time.monotonic() - finished
+            try:
+                self._deliver_func(result, *args)
+            except Exception:
+                log.exception('Error while delivering decrypted message')
+
+        log.debug('Queue depth: %s', self.queue_depth)
+        return False
+
+    def get_stats(self):
+        processed = self.processed or 1
+        return {
+            'queue_depth': self.queue_depth,
+            'processed': self.processed,
+            'avg_wait': self.wait_time / processed,
+            'avg_decrypt': self.decrypt_time / processed,
+            'avg_reorder': self.reorder_time / processed,
+            'sync_processed': self.sync_processed,
+            'sync_rate': self.sync_rate,
+        }
+
+    def shutdown(self):
+        self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._finished.clear()
+        log.info('Decryption pipeline stats: %s', self.get_stats())
+
+
+class EncryptionQueue:
+    '''
+    Runs encryption jobs on a bounded executor, jobs with the same key
+    (e.g. the same conversation) run one after another, jobs with
+    different keys run in parallel
+    '''
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 2
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='openpgp-encrypt')
+
+        self._queues = {}
+        self._closed = False
+
+    def submit(self, key, func, args, callback):
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append((func, args, callback))
+            return
+
+        self._queues[key] = deque()
+        self._start(key, func, args, callback)
+
+    def _start(self, key, func, args, callback):
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(partial(self._on_done, key, callback))
+
+    def _on_done(self, key, callback, future):
+        # Called on the worker thread
+        if future.cancelled():
+            return
+        GLib.idle_add(self._finish, key, callback, future)
+
+    def _finish(self, key, callback, future):
+        if self._closed:
+            return False
+
+        try:
+            callback(future.result())
+        except Exception:
+            log.exception('Error while encrypting message')
+
+        queue = self._queues[key]
+        if queue:
+            self._start(key, *queue.popleft())
+        else:
+            del self._queues[key]
+        return False
+
+    def shutdown(self):
+        self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._queues.clear()
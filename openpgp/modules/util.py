@@ -19,6 +19,8 @@ from collections import namedtuple
 
 from nbxmpp.namespaces import Namespace
 
+from gajim.common import modules
+
 
 ENCRYPTION_NAME = 'OpenPGP'
 
@@ -33,6 +35,27 @@ NOT_ENCRYPTED_TAGS = [
 
 Key = namedtuple('Key', 'fingerprint date')
 
+# nbxmpp modules which parse properties of a message stanza, they
+# have to see the decrypted content
+NBXMPP_MESSAGE_MODULES = (
+    'BaseMessage',
+    'MUC',
+    'Attention',
+    'ChatMarkers',
+    'Chatstates',
+    'Correction',
+    'Delay',
+    'EME',
+    'OOB',
+    'Receipts',
+    'Reactions',
+    'Replies',
+    'SecurityLabels',
+    'HTTPAuth',
+    'Captcha',
+    'Nickname',
+)
+
 
 class Trust(IntEnum):
     NOT_TRUSTED = 0
@@ -73,3 +96,19 @@ class VerifyFailed(Exception):
 
 class DecryptionFailed(Exception):
     pass
+
+
+def get_message_handlers(client):
+    '''
+    Collects the message handlers of the nbxmpp and Gajim modules
+    of the client
+    '''
+    handlers = list(modules.get_handlers(client))
+    for name in NBXMPP_MESSAGE_MODULES:
+        try:
+            module = client.connection.get_module(name)
+        except KeyError:
+            # Not available in this nbxmpp version
+            continue
+        handlers += module.handlers
+    return [handler for handler in handlers if handler.name == 'message']
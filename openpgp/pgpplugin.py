@@ -17,6 +17,7 @@
 import logging
 from pathlib import Path
 
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import Gdk
 from nbxmpp.namespaces import Namespace
@@ -42,9 +43,23 @@ else:
 
 log = logging.getLogger('gajim.p.openpgp')
 
+# Delay between the sync of two accounts in milliseconds
+SYNC_INTERVAL = 2000
+
 
 class OpenPGPPlugin(GajimPlugin):
     def init(self):
+        # pylint: disable=attribute-defined-outside-init
+        self.config_default_values = {
+            'synchronous': (
+                'FULL',
+                'sqlite durability of contacts.db: OFF, NORMAL, FULL '
+                'or EXTRA'),
+            'flush_interval': (
+                2,
+                'Seconds contacts.db writes are collected before they are '
+                'written, 0 writes immediately'),
+        }
         if ERROR_MSG:
             self.activatable = False
             self.available_text = ERROR_MSG
@@ -76,6 +91,8 @@ class OpenPGPPlugin(GajimPlugin):
         self.announced = []
         self.own_key = None
         self.pgp_instances = {}
+        self._sync_queue = []
+        self._sync_source_id = None
         self._create_paths()
         self._load_css()
 
@@ -105,25 +122,46 @@ class OpenPGPPlugin(GajimPlugin):
 
     def signed_in(self, event):
         client = app.get_client(event.account)
-        if client.get_module('OpenPGP').secret_key_available:
-            log.info('%s => Publish keylist and public key after sign in',
-                     event.account)
-            client.get_module('OpenPGP').request_keylist()
-            client.get_module('OpenPGP').set_public_key()
+        client.get_module('OpenPGP').reset_key_requests()
+        self._schedule_sync(event.account)
 
     def activate(self):
         for account in app.settings.get_active_accounts():
             client = app.get_client(account)
             client.get_module('Caps').update_caps()
             if app.account_is_connected(account):
-                if client.get_module('OpenPGP').secret_key_available:
-                    log.info('%s => Publish keylist and public key '
-                             'after plugin activation', account)
-                    client.get_module('OpenPGP').request_keylist()
-                    client.get_module('OpenPGP').set_public_key()
+                self._schedule_sync(account)
 
     def deactivate(self):
-        pass
+        self._sync_queue.clear()
+        if self._sync_source_id is not None:
+            GLib.source_remove(self._sync_source_id)
+            self._sync_source_id = None
+
+    def _schedule_sync(self, account):
+        # Accounts are synced one after another to spread the load
+        # when many accounts sign in at the same time
+        if account in self._sync_queue:
+            return
+
+        self._sync_queue.append(account)
+        if self._sync_source_id is None:
+            self._sync_source_id = GLib.idle_add(self._sync_next_account)
+
+    def _sync_next_account(self):
+        account = self._sync_queue.pop(0)
+        if app.account_is_connected(account):
+            client = app.get_client(account)
+            if client.get_module('OpenPGP').secret_key_available:
+                log.info('%s => Sync keylist and public key', account)
+                client.get_module('OpenPGP').sync()
+
+        if self._sync_queue:
+            self._sync_source_id = GLib.timeout_add(SYNC_INTERVAL,
+                                                    self._sync_next_account)
+        else:
+            self._sync_source_id = None
+        return False
 
     @staticmethod
     def _update_caps(_account, features):
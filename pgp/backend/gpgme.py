@@ -0,0 +1,366 @@
+# Copyright (C) 2019 Philipp Hörist <philipp AT hoerist.com>
+#
+# This file is part of the PGP Gajim Plugin.
+#
+# PGP Gajim Plugin is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; version 3 only.
+#
+# PGP Gajim Plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import gpg
+
+from gajim.common.util.classes import Singleton
+
+from pgp.backend.util import SignatureCache
+from pgp.exceptions import SignError
+
+
+logger = logging.getLogger('gajim.p.pgplegacy')
+
+VERIFY_CACHE_SIZE = 512
+
+TRUSTED = (gpg.constants.validity.FULL, gpg.constants.validity.ULTIMATE)
+
+# Files that change when keys are imported, deleted or their trust changes
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'trustdb.gpg')
+
+
+class ContextPool:
+    '''
+    Holds configured gpg contexts for reuse across operations
+    '''
+    def __init__(self, context_args, binary=None, size=4):
+        self._context_args = context_args
+        self._binary = binary
+        self._size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.reused = 0
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.created += 1
+
+        context = gpg.Context(**self._context_args)
+        if self._binary is not None:
+            context.set_engine_info(gpg.constants.protocol.OpenPGP,
+                                    file_name=self._binary)
+        return context
+
+    def _release(self, context):
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(context)
+
+    @contextmanager
+    def context(self):
+        # The context may be in an undefined state after an error,
+        # only contexts of successful operations are reused
+        context = self._acquire()
+        yield context
+        self._release(context)
+
+
+class EncryptResult:
+    def __init__(self, status=None):
+        self.status = status or 'encryption ok'
+        self.ok = status is None
+
+    def __bool__(self):
+        return self.ok
+
+
+class ListKeys(list):
+    @property
+    def fingerprints(self):
+        return [key['fingerprint'] for key in self]
+
+
+class PGP(metaclass=Singleton):
+    '''
+    GPGME implementation of the python-gnupg backend, key lookups,
+    status parsing and signature checks happen inside gpgme
+    '''
+    def __init__(self, binary, encoding=None):
+        path = shutil.which(binary) if binary is not None else None
+        self._pool = ContextPool({'armor': True}, binary=path)
+        self.encoding = encoding or 'utf8'
+
+        self._verify_lock = threading.Lock()
+        self._verify_cache = OrderedDict()
+        self.verify_attempts = 0
+        self.verify_count = 0
+
+        homedir = gpg.core.get_dirinfo('homedir')
+        self._keyring_paths = [os.path.join(homedir, name)
+                               for name in KEYRING_FILES]
+
+        # Recipient keys including their validity, keyed by key id
+        self._key_lock = threading.Lock()
+        self._key_cache = {}
+        self._keyring_mtime = self._get_keyring_mtime()
+
+        self.sign_cache = SignatureCache()
+
+    def _get_keyring_mtime(self):
+        mtime = 0
+        for path in self._keyring_paths:
+            try:
+                mtime = max(mtime, os.stat(path).st_mtime_ns)
+            except OSError:
+                pass
+        return mtime
+
+    def _check_keyring(self):
+        mtime = self._get_keyring_mtime()
+        with self._key_lock:
+            if mtime == self._keyring_mtime:
+                return
+            self._keyring_mtime = mtime
+            self._key_cache.clear()
+        logger.info('Keyring changed, clear key and signature cache')
+        self.sign_cache.invalidate()
+        with self._verify_lock:
+            self._verify_cache.clear()
+
+    def invalidate_trust_cache(self, fingerprint=None):
+        with self._key_lock:
+            if fingerprint is None:
+                self._key_cache.clear()
+            else:
+                self._key_cache.pop(fingerprint, None)
+
+    def _get_recipient_key(self, context, key_id):
+        self._check_keyring()
+        with self._key_lock:
+            if key_id in self._key_cache:
+                return self._key_cache[key_id]
+
+        key = self._get_key(context, key_id)
+        if key is not None:
+            with self._key_lock:
+                self._key_cache[key_id] = key
+        return key
+
+    def encrypt(self, payload, recipients, always_trust=False):
+        with self._pool.context() as context:
+            keys = []
+            for recipient in recipients:
+                key = self._get_recipient_key(context, recipient)
+                if key is None:
+                    return '', 'INV_RECP %s' % recipient
+                keys.append(key)
+
+            if not always_trust:
+                # check that we'll be able to encrypt
+                validity = max((uid.validity for uid in keys[0].uids),
+                               default=gpg.constants.validity.UNKNOWN)
+                if validity not in TRUSTED:
+                    return '', 'NOT_TRUSTED ' + keys[0].fpr[-8:]
+
+            try:
+                ciphertext, _result, _sign_result = context.encrypt(
+                    payload.encode('utf8'),
+                    recipients=keys,
+                    sign=False,
+                    always_trust=always_trust)
+            except gpg.errors.GpgError as error:
+                # InvalidRecipients and the other result errors are no
+                # GPGMEError, report all of them like python-gnupg
+                return '', str(error)
+
+        return self._strip_header_footer(ciphertext.decode('utf8')), ''
+
+    def encrypt_file(self, file, recipients, output=None):
+        with self._pool.context() as context:
+            keys = [self._get_key(context, recipient)
+                    for recipient in recipients]
+            if None in keys:
+                return EncryptResult('invalid recipient')
+
+            def _read(amount, _hook=None):
+                return file.read(amount)
+
+            plaintext = gpg.Data(cbs=(_read, None, None, None))
+            try:
+                with open(output, 'wb') as sink:
+                    context.encrypt(plaintext,
+                                    recipients=keys,
+                                    sink=sink,
+                                    sign=False)
+            except (OSError, gpg.errors.GpgError) as error:
+                return EncryptResult(str(error))
+
+        return EncryptResult()
+
+    def decrypt(self, payload):
+        with self._pool.context() as context:
+            return self._decrypt(context, payload)
+
+    def _decrypt(self, context, payload):
+        data = self._add_header_footer(payload, 'MESSAGE')
+        try:
+            plaintext, _result, _verify_result = context.decrypt(
+                data.encode('utf8'), verify=False)
+        except gpg.errors.GpgError as error:
+            # Same as python-gnupg, a failed decryption has no data
+            logger.warning('Decryption failed: %s', error)
+            return ''
+        return plaintext.decode('utf8')
+
+    def get_cached_signature(self, payload, key_id):
+        if payload is None:
+            payload = ''
+        # Signatures made before the keyring changed are dropped first
+        self._check_keyring()
+        return self.sign_cache.get(key_id, payload)
+
+    def sign(self, payload, key_id):
+        if payload is None:
+            payload = ''
+
+        signature = self.get_cached_signature(payload, key_id)
+        if signature is not None:
+            return signature
+
+        with self._pool.context() as context:
+            key = self._get_key(context, key_id, secret=True)
+            if key is None:
+                raise SignError('No secret key found: %s' % key_id)
+
+            context.signers = [key]
+            try:
+                signature, _result = context.sign(
+                    payload.encode('utf8'),
+                    mode=gpg.constants.sig.mode.DETACH)
+            except gpg.errors.GpgError as error:
+                raise SignError(str(error))
+            finally:
+                context.signers = []
+
+        signature = self._strip_header_footer(signature.decode('utf8'))
+        self.sign_cache.set(key_id, payload, signature)
+        return signature
+
+    def verify(self, payload, signed, jid=None):
+        # The detached signature is verified directly, gpgme reads the
+        # hash algorithm from the signature so there is no need to try
+        # each algorithm like with python-gnupg
+        if payload is None:
+            payload = ''
+
+        # Misses are cached as None until the keyring changes, so
+        # presences signed with unknown keys are not verified each time
+        self._check_keyring()
+        cache_key = (payload, signed)
+        with self._verify_lock:
+            if cache_key in self._verify_cache:
+                self._verify_cache.move_to_end(cache_key)
+                return self._verify_cache[cache_key]
+
+        signature = self._add_header_footer(signed, 'SIGNATURE')
+        with self._pool.context() as context:
+            try:
+                _data, result = context.verify(
+                    payload.encode('utf8'),
+                    signature=signature.encode('utf8'))
+            except gpg.errors.GpgError as error:
+                # BadSignatures is raised for a missing public key too
+                logger.info('Presence verification of %s failed: %s',
+                            jid, error)
+                result = None
+
+        fingerprint = None
+        if result is not None and result.signatures:
+            fingerprint = result.signatures[0].fpr
+
+        with self._verify_lock:
+            self.verify_count += 1
+            self.verify_attempts += 1
+            self._verify_cache[cache_key] = fingerprint
+            if len(self._verify_cache) > VERIFY_CACHE_SIZE:
+                self._verify_cache.popitem(last=False)
+        return fingerprint
+
+    @staticmethod
+    def _get_key(context, key_id, secret=False):
+        try:
+            return context.get_key(key_id, secret=secret)
+        except (gpg.errors.KeyNotFound, gpg.errors.GPGMEError) as error:
+            logger.warning('Key not found: %s %s', key_id, error)
+            return None
+
+    def get_key(self, key_id):
+        return self.list_keys(keys=[key_id])
+
+    def get_keys(self, secret=False):
+        keys = {}
+        for key in self.list_keys(secret=secret):
+            # Take first not empty uid
+            keys[key['fingerprint']] = next(uid for uid in key['uids'] if uid)
+        return keys
+
+    def list_keys(self, secret=False, keys=None):
+        result = ListKeys()
+        patterns = keys or [None]
+        with self._pool.context() as context:
+            for pattern in patterns:
+                for key in context.keylist(pattern=pattern, secret=secret):
+                    result.append({
+                        'fingerprint': key.fpr,
+                        'keyid': key.fpr[-16:],
+                        'uids': [uid.uid for uid in key.uids],
+                    })
+        return result
+
+    @staticmethod
+    def _strip_header_footer(data):
+        """
+        Remove header and footer from data
+        """
+        if not data:
+            return ''
+        lines = data.splitlines()
+        while lines[0] != '':
+            lines.remove(lines[0])
+        while lines[0] == '':
+            lines.remove(lines[0])
+        i = 0
+        for line in lines:
+            if line:
+                if line[0] == '-':
+                    break
+            i = i+1
+        line = '\n'.join(lines[0:i])
+        return line
+
+    @staticmethod
+    def _add_header_footer(data, type_):
+        """
+        Add header and footer from data
+        """
+        out = "-----BEGIN PGP %s-----" % type_ + os.linesep
+        out = out + "Version: PGP" + os.linesep
+        out = out + os.linesep
+        out = out + data + os.linesep
+        out = out + "-----END PGP %s-----" % type_ + os.linesep
+        return out
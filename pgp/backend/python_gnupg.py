@@ -21,13 +21,16 @@
 # along with PGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import base64
 import logging
-from functools import lru_cache
+import threading
+from collections import OrderedDict
 
 import gnupg
 
 from gajim.common.util.classes import Singleton
 
+from pgp.backend.util import SignatureCache
 from pgp.exceptions import SignError
 
 
@@ -37,6 +40,22 @@ if logger.getEffectiveLevel() == logging.DEBUG:
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.DEBUG)
 
+# Text names for hash algorithms from RFC 4880 - section 9.4
+HASH_ALGORITHMS = {
+    1: 'MD5',
+    2: 'SHA1',
+    3: 'RIPEMD160',
+    8: 'SHA256',
+    9: 'SHA384',
+    10: 'SHA512',
+    11: 'SHA224',
+}
+
+VERIFY_CACHE_SIZE = 512
+
+# Files that change when keys are imported, deleted or their trust changes
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'trustdb.gpg')
+
 
 class PGP(gnupg.GPG, metaclass=Singleton):
     def __init__(self, binary, encoding=None):
@@ -47,13 +66,81 @@ class PGP(gnupg.GPG, metaclass=Singleton):
             self.encoding = encoding
         self.decode_errors = 'replace'
 
+        self._verify_lock = threading.Lock()
+        self._verify_cache = OrderedDict()
+        self._hash_algorithms = {}
+        self.verify_attempts = 0
+        self.verify_count = 0
+
+        homedir = self.gnupghome or os.environ.get('GNUPGHOME')
+        if homedir is None:
+            if os.name == 'nt':
+                homedir = os.path.join(os.environ.get('APPDATA', ''),
+                                       'gnupg')
+            else:
+                homedir = os.path.expanduser('~/.gnupg')
+        self._keyring_paths = [os.path.join(homedir, name)
+                               for name in KEYRING_FILES]
+
+        self._trust_lock = threading.Lock()
+        self._trust_cache = {}
+        self._keyring_mtime = self._get_keyring_mtime()
+
+        self.sign_cache = SignatureCache()
+
+    def _get_keyring_mtime(self):
+        mtime = 0
+        for path in self._keyring_paths:
+            try:
+                mtime = max(mtime, os.stat(path).st_mtime_ns)
+            except OSError:
+                pass
+        return mtime
+
+    def _check_keyring(self):
+        mtime = self._get_keyring_mtime()
+        with self._trust_lock:
+            if mtime == self._keyring_mtime:
+                return
+            self._keyring_mtime = mtime
+            self._trust_cache.clear()
+        logger.info('Keyring changed, clear trust and signature cache')
+        self.sign_cache.invalidate()
+        with self._verify_lock:
+            self._verify_cache.clear()
+
+    def invalidate_trust_cache(self, fingerprint=None):
+        with self._trust_lock:
+            if fingerprint is None:
+                self._trust_cache.clear()
+            else:
+                self._trust_cache.pop(fingerprint, None)
+
+    def _check_trust(self, fingerprint):
+        '''
+        Returns None if the key is trusted, otherwise the error
+        '''
+        self._check_keyring()
+        with self._trust_lock:
+            if fingerprint in self._trust_cache:
+                return self._trust_cache[fingerprint]
+
+        error = None
+        for key in self.get_key(fingerprint):
+            if key['trust'] not in ('f', 'u'):
+                error = 'NOT_TRUSTED ' + key['keyid'][-8:]
+                break
+
+        with self._trust_lock:
+            self._trust_cache[fingerprint] = error
+        return error
+
     def encrypt(self, payload, recipients, always_trust=False):
         if not always_trust:
             # check that we'll be able to encrypt
-            result = self.get_key(recipients[0])
-            for key in result:
-                if key['trust'] not in ('f', 'u'):
-                    return '', 'NOT_TRUSTED ' + key['keyid'][-8:]
+            error = self._check_trust(recipients[0])
+            if error is not None:
+                return '', error
 
         result = super().encrypt(
             payload.encode('utf8'),
@@ -73,29 +160,63 @@ class PGP(gnupg.GPG, metaclass=Singleton):
 
         return result.data.decode('utf8')
 
-    @lru_cache(maxsize=8)
+    def get_cached_signature(self, payload, key_id):
+        if payload is None:
+            payload = ''
+        # Signatures made before the keyring changed are dropped first
+        self._check_keyring()
+        return self.sign_cache.get(key_id, payload)
+
     def sign(self, payload, key_id):
         if payload is None:
             payload = ''
+
+        signature = self.get_cached_signature(payload, key_id)
+        if signature is not None:
+            return signature
+
         result = super().sign(payload.encode('utf8'),
                               keyid=key_id,
                               detach=True)
 
-        if result.fingerprint:
-            return self._strip_header_footer(str(result))
-        raise SignError(result.status)
+        if not result.fingerprint:
+            raise SignError(result.status)
 
-    def verify(self, payload, signed):
-        # Hash algorithm is not transfered in the signed
-        # presence stanza so try all algorithms.
-        # Text name for hash algorithms from RFC 4880 - section 9.4
+        signature = self._strip_header_footer(str(result))
+        self.sign_cache.set(key_id, payload, signature)
+        return signature
 
+    def verify(self, payload, signed, jid=None):
         if payload is None:
             payload = ''
 
-        hash_algorithms = ['SHA512', 'SHA384', 'SHA256',
-                           'SHA224', 'SHA1', 'RIPEMD160']
-        for algo in hash_algorithms:
+        # Results of deleted or revoked keys must not be reused
+        self._check_keyring()
+        cache_key = (payload, signed)
+        with self._verify_lock:
+            fingerprint = self._verify_cache.get(cache_key)
+            if fingerprint is not None:
+                self._verify_cache.move_to_end(cache_key)
+                return fingerprint
+
+        # Hash algorithm is not transfered in the signed presence stanza,
+        # read it from the signature packet, then try the algorithm the
+        # contact used last time and then all others.
+        algorithms = []
+        detected = self._get_signature_hash_algorithm(signed)
+        if detected is not None:
+            algorithms.append(detected)
+        remembered = self._hash_algorithms.get(jid)
+        if remembered is not None and remembered not in algorithms:
+            algorithms.append(remembered)
+        for algo in ('SHA512', 'SHA384', 'SHA256',
+                     'SHA224', 'SHA1', 'RIPEMD160'):
+            if algo not in algorithms:
+                algorithms.append(algo)
+
+        attempts = 0
+        for algo in algorithms:
+            attempts += 1
             data = os.linesep.join(
                 ['-----BEGIN PGP SIGNED MESSAGE-----',
                  'Hash: ' + algo,
@@ -105,7 +226,65 @@ class PGP(gnupg.GPG, metaclass=Singleton):
                 )
             result = super().verify(data.encode('utf8'))
             if result.valid:
-                return result.fingerprint
+                fingerprint = result.fingerprint
+                break
+
+        logger.debug('Presence verification needed %s attempts', attempts)
+        with self._verify_lock:
+            self.verify_count += 1
+            self.verify_attempts += attempts
+            if fingerprint is None:
+                return None
+
+            if jid is not None:
+                self._hash_algorithms[jid] = algo
+            self._verify_cache[cache_key] = fingerprint
+            if len(self._verify_cache) > VERIFY_CACHE_SIZE:
+                self._verify_cache.popitem(last=False)
+        return fingerprint
+
+    @staticmethod
+    def _get_signature_hash_algorithm(signed):
+        '''
+        Read the hash algorithm from the OpenPGP signature packet
+        (RFC 4880 - section 4.2 and 5.2)
+        '''
+        lines = [line for line in signed.splitlines()
+                 if line and not line.startswith('=')]
+        try:
+            data = base64.b64decode(''.join(lines))
+        except ValueError:
+            return None
+
+        if len(data) < 2 or not data[0] & 0x80:
+            return None
+
+        if data[0] & 0x40:
+            # New packet format
+            packet_tag = data[0] & 0x3f
+            if data[1] < 192 or data[1] > 223:
+                offset = 2 if data[1] != 255 else 6
+            else:
+                offset = 3
+        else:
+            # Old packet format
+            packet_tag = (data[0] >> 2) & 0x0f
+            offset = 1 + {0: 1, 1: 2, 2: 4, 3: 0}[data[0] & 0x03]
+
+        if packet_tag != 2:
+            return None
+
+        body = data[offset:]
+        if len(body) < 17:
+            return None
+
+        if body[0] == 3:
+            hash_algorithm = body[16]
+        elif body[0] in (4, 5):
+            hash_algorithm = body[3]
+        else:
+            return None
+        return HASH_ALGORITHMS.get(hash_algorithm)
 
     def get_key(self, key_id):
         return super().list_keys(keys=[key_id])
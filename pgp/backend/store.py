@@ -15,12 +15,30 @@
 # along with PGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import sqlite3
 from pathlib import Path
 
+from gi.repository import GLib
+
 from gajim.common import app
 from gajim.common import configpaths
 
-CURRENT_STORE_VERSION = 3
+CURRENT_STORE_VERSION = 4
+
+# Last version of the json store, newer versions use sqlite
+JSON_STORE_VERSION = 3
+
+TABLE_LAYOUT = '''
+    CREATE TABLE own_key (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        key_id TEXT,
+        key_user TEXT
+        );
+    CREATE TABLE contact_keys (
+        contact TEXT PRIMARY KEY,
+        key_id TEXT,
+        key_user TEXT
+        );'''
 
 
 class KeyResolveError(Exception):
@@ -28,17 +46,45 @@ class KeyResolveError(Exception):
 
 
 class KeyStore:
-    def __init__(self, account, own_jid, log, list_keys_func):
+    '''
+    Keeps all key bindings in memory, changes are written to a sqlite
+    database in one transaction after flush_interval seconds
+    '''
+    def __init__(self, account, own_jid, log, list_keys_func,
+                 flush_interval=2):
         self._list_keys_func = list_keys_func
         self._log = log
         self._account = account
 
+        self._flush_interval = flush_interval
+        self._flush_source_id = None
+        self._pending = set()
+        self._own_key_pending = False
+
         own_bare_jid = own_jid.bare
         path = Path(configpaths.get('PLUGINS_DATA')) / 'pgplegacy' / own_bare_jid
         if not path.exists():
             path.mkdir(parents=True)
 
+        self._con = sqlite3.connect(str(path / 'store.db'))
+        self._con.execute('PRAGMA journal_mode=WAL;')
+        self._con.execute('PRAGMA synchronous=NORMAL;')
+
+        version = self._con.execute('PRAGMA user_version').fetchone()[0]
+        if version > CURRENT_STORE_VERSION:
+            raise Exception('Unknown store version! '
+                            'Please upgrade pgp plugin.')
+
+        if version == CURRENT_STORE_VERSION:
+            self._store = self._load_store()
+            return
+
         self._store_path = path / 'store'
+        self._load_json_store()
+        self._create_store()
+
+    def _load_json_store(self):
+        log = self._log
         if self._store_path.exists():
             # having store v2 or higher
             with self._store_path.open('r') as file:
@@ -49,13 +95,12 @@ class KeyStore:
                     self._store = self._empty_store()
 
             ver = self._store.get('_version', 2)
-            if ver > CURRENT_STORE_VERSION:
+            if ver > JSON_STORE_VERSION:
                 raise Exception('Unknown store version! '
                                 'Please upgrade pgp plugin.')
             elif ver == 2:
                 self._migrate_v2_store()
-                self._save_store()
-            elif ver != CURRENT_STORE_VERSION:
+            elif ver != JSON_STORE_VERSION:
                 # garbled version
                 self._store = self._empty_store()
                 log.warning('Bad pgp key store version. Initializing new.')
@@ -64,12 +109,46 @@ class KeyStore:
             self._store = self._empty_store()
             self._migrate_v1_store()
             self._migrate_v2_store()
-            self._save_store()
+
+    def _create_store(self):
+        # Tables and data are created in one transaction, an interrupted
+        # migration starts again from the json store
+        contacts = [(contact, key_data['key_id'], key_data['key_user'])
+                    for contact, key_data
+                    in self._store['contact_key_data'].items()
+                    if key_data is not None]
+
+        self._con.executescript('BEGIN TRANSACTION;' + TABLE_LAYOUT)
+        self._con.executemany(
+            'INSERT INTO contact_keys(contact, key_id, key_user) '
+            'VALUES(?, ?, ?)', contacts)
+        own_key_data = self._store['own_key_data']
+        if own_key_data is not None:
+            self._con.execute(
+                'INSERT INTO own_key(id, key_id, key_user) VALUES(0, ?, ?)',
+                (own_key_data['key_id'], own_key_data['key_user']))
+        self._con.execute('PRAGMA user_version=%s' % CURRENT_STORE_VERSION)
+        self._con.commit()
+        self._log.info('Created store v%s with %s contacts',
+                       CURRENT_STORE_VERSION, len(contacts))
+
+    def _load_store(self):
+        store = self._empty_store()
+        row = self._con.execute(
+            'SELECT key_id, key_user FROM own_key').fetchone()
+        if row is not None:
+            store['own_key_data'] = {'key_id': row[0], 'key_user': row[1]}
+
+        store['contact_key_data'] = {
+            contact: {'key_id': key_id, 'key_user': key_user}
+            for contact, key_id, key_user in self._con.execute(
+                'SELECT contact, key_id, key_user FROM contact_keys')}
+        return store
 
     @staticmethod
     def _empty_store():
         return {
-            '_version': CURRENT_STORE_VERSION,
+            '_version': JSON_STORE_VERSION,
             'own_key_data': None,
             'contact_key_data': {},
         }
@@ -120,12 +199,66 @@ class KeyStore:
         for dict_key in prune_list:
             del self._store['contact_key_data'][dict_key]
 
-        self._store['_version'] = CURRENT_STORE_VERSION
+        self._store['_version'] = JSON_STORE_VERSION
         self._log.info('Migration from store v2 was successful')
 
-    def _save_store(self):
-        with self._store_path.open('w') as file:
-            json.dump(self._store, file)
+    def _schedule_flush(self):
+        if not self._flush_interval:
+            self.flush()
+            return
+
+        if self._flush_source_id is None:
+            self._flush_source_id = GLib.timeout_add_seconds(
+                self._flush_interval, self._on_flush_timeout)
+
+    def _on_flush_timeout(self):
+        self._flush_source_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        if self._flush_source_id is not None:
+            GLib.source_remove(self._flush_source_id)
+            self._flush_source_id = None
+
+        if not self._pending and not self._own_key_pending:
+            return
+
+        replace = []
+        delete = []
+        key_ids = self._store['contact_key_data']
+        for contact in self._pending:
+            key_data = key_ids.get(contact)
+            if key_data is None:
+                delete.append((contact,))
+            else:
+                replace.append(
+                    (contact, key_data['key_id'], key_data['key_user']))
+        self._pending.clear()
+
+        with self._con:
+            self._con.executemany(
+                'REPLACE INTO contact_keys(contact, key_id, key_user) '
+                'VALUES(?, ?, ?)', replace)
+            self._con.executemany(
+                'DELETE FROM contact_keys WHERE contact = ?', delete)
+
+            if self._own_key_pending:
+                self._own_key_pending = False
+                self._con.execute('DELETE FROM own_key')
+                own_key_data = self._store['own_key_data']
+                if own_key_data is not None:
+                    self._con.execute(
+                        'INSERT INTO own_key(id, key_id, key_user) '
+                        'VALUES(0, ?, ?)',
+                        (own_key_data['key_id'], own_key_data['key_user']))
+
+        self._log.info('Key store flushed: %s changes',
+                       len(replace) + len(delete))
+
+    def cleanup(self):
+        self.flush()
+        self._con.close()
 
     def _get_dict_key(self, jid):
         return '%s-%s' % (self._account, jid)
@@ -147,7 +280,8 @@ class KeyStore:
 
     def set_own_key_data(self, key_data):
         self._set_own_key_data_nosync(key_data)
-        self._save_store()
+        self._own_key_pending = True
+        self._schedule_flush()
 
     def _set_own_key_data_nosync(self, key_data):
         if key_data is None:
@@ -168,7 +302,8 @@ class KeyStore:
 
     def set_contact_key_data(self, jid, key_data):
         self._set_contact_key_data_nosync(jid, key_data)
-        self._save_store()
+        self._pending.add(self._get_dict_key(jid))
+        self._schedule_flush()
 
     def _set_contact_key_data_nosync(self, jid, key_data):
         key_ids = self._store['contact_key_data']
@@ -0,0 +1,79 @@
+# This file is part of the PGP Gajim Plugin.
+#
+# PGP Gajim Plugin is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; version 3 only.
+#
+# PGP Gajim Plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+from collections import OrderedDict
+
+
+SIGN_CACHE_SIZE = 32
+SIGN_CACHE_TTL = 3600
+
+
+class SignatureCache:
+    '''
+    Caches detached signatures of status messages per key, all
+    accounts using the same key share the entries
+    '''
+    def __init__(self, size=SIGN_CACHE_SIZE, ttl=SIGN_CACHE_TTL):
+        self._size = size
+        self._ttl = ttl
+        self._keys = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, size, ttl):
+        with self._lock:
+            self._size = size
+            self._ttl = ttl
+            for signatures in self._keys.values():
+                self._shrink(signatures)
+
+    def _shrink(self, signatures):
+        while len(signatures) > self._size:
+            signatures.popitem(last=False)
+
+    def get(self, key_id, payload):
+        with self._lock:
+            signatures = self._keys.get(key_id)
+            entry = None if signatures is None else signatures.get(payload)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            created, signature = entry
+            if time.monotonic() - created > self._ttl:
+                del signatures[payload]
+                self.misses += 1
+                return None
+
+            signatures.move_to_end(payload)
+            self.hits += 1
+            return signature
+
+    def set(self, key_id, payload, signature):
+        with self._lock:
+            signatures = self._keys.setdefault(key_id, OrderedDict())
+            signatures[payload] = (time.monotonic(), signature)
+            signatures.move_to_end(payload)
+            self._shrink(signatures)
+
+    def invalidate(self, key_id=None):
+        with self._lock:
+            if key_id is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(key_id, None)
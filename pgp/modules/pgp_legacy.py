@@ -15,11 +15,16 @@
 # along with PGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import mmap
 import time
+import tempfile
 import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 import nbxmpp
 from nbxmpp.namespaces import Namespace
+from nbxmpp.protocol import NodeProcessed
 from nbxmpp.structs import StanzaHandler
 from gi.repository import GLib
 
@@ -30,20 +35,31 @@ from gajim.common.modules.base import BaseModule
 
 from gajim.plugins.plugins_i18n import _
 
-from pgp.backend.python_gnupg import PGP
 from pgp.modules.events import PGPFileEncryptionError
 from pgp.modules.events import PGPNotTrusted
 from pgp.modules.util import prepare_stanza
+from pgp.modules.util import get_message_handlers
+from pgp.modules.util import ProgressReader
+from pgp.modules.pipeline import DecryptionPipeline
+from pgp.modules.pipeline import VerificationQueue
+from pgp.modules.pipeline import resume_handlers
 from pgp.backend.store import KeyStore
 from pgp.exceptions import SignError
 from pgp.exceptions import KeyMismatch
 from pgp.exceptions import NoKeyIdFound
 
+try:
+    from pgp.backend.gpgme import PGP
+except ImportError:
+    from pgp.backend.python_gnupg import PGP
+
 
 # Module name
 name = 'PGPLegacy'
 zeroconf = True
 
+DECRYPT_PRIORITY = 9
+
 ALLOWED_TAGS = [('request', Namespace.RECEIPTS),
                 ('active', Namespace.CHATSTATES),
                 ('gone', Namespace.CHATSTATES),
@@ -58,6 +74,38 @@ ALLOWED_TAGS = [('request', Namespace.RECEIPTS),
                 ('origin-id', Namespace.SID),
                 ]
 
+# Workers of the executors shared by all accounts
+EXECUTORS = {
+    # Limits the number of concurrent gpg processes for file encryption
+    'file-encryption': 2,
+    # Signs presences missing in the cache, one gpg process at a time
+    'sign': 1,
+    # Signs the status presets, kept apart so presences never wait
+    # behind it
+    'precompute': 1,
+}
+
+_executors = {}
+
+
+def get_executor(name):
+    executor = _executors.get(name)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=EXECUTORS[name],
+                                      thread_name_prefix='pgp-%s' % name)
+        _executors[name] = executor
+    return executor
+
+
+def shutdown_executors():
+    '''
+    Drops queued jobs without waiting for running ones, otherwise exiting
+    waits until a running file encryption is done
+    '''
+    for executor in _executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    _executors.clear()
+
 
 class PGPLegacy(BaseModule):
     def __init__(self, client):
@@ -67,7 +115,7 @@ class PGPLegacy(BaseModule):
             StanzaHandler(name='message',
                           callback=self._message_received,
                           ns=Namespace.ENCRYPTED,
-                          priority=9),
+                          priority=DECRYPT_PRIORITY),
             StanzaHandler(name='presence',
                           callback=self._on_presence_received,
                           ns=Namespace.SIGNED,
@@ -81,19 +129,34 @@ class PGPLegacy(BaseModule):
                                self._pgp.list_keys)
         self._always_trust = []
         self._presence_fingerprint_store = {}
+        self._decryption = DecryptionPipeline(self._pgp.decrypt,
+                                              self._on_message_decrypted)
+        self._verification = VerificationQueue(self._pgp.verify,
+                                               self._on_presence_verified)
+        self.unsigned_presences = 0
+        self._precomputed = False
+        self._pending_signatures = set()
+        self._file_jobs = {}
 
     @property
     def pgp_backend(self):
         return self._pgp
 
-    def set_own_key_data(self, *args, **kwargs):
-        return self._store.set_own_key_data(*args, **kwargs)
+    def set_own_key_data(self, key_data):
+        old_key_data = self.get_own_key_data()
+        if old_key_data is not None:
+            self._pgp.sign_cache.invalidate(old_key_data['key_id'])
+        self._store.set_own_key_data(key_data)
+        self.precompute_signatures()
 
     def get_own_key_data(self, *args, **kwargs):
         return self._store.get_own_key_data(*args, **kwargs)
 
-    def set_contact_key_data(self, *args, **kwargs):
-        return self._store.set_contact_key_data(*args, **kwargs)
+    def set_contact_key_data(self, jid, key_data):
+        if key_data is not None:
+            # Trust of a newly assigned key is checked again on send
+            self._pgp.invalidate_trust_cache(key_data[0])
+        return self._store.set_contact_key_data(jid, key_data)
 
     def get_contact_key_data(self, *args, **kwargs):
         return self._store.get_contact_key_data(*args, **kwargs)
@@ -104,6 +167,9 @@ class PGPLegacy(BaseModule):
             return False
         key_id = key_data['key_id']
 
+        # Only wait for a verification if the user is about to send
+        self._verification.wait(jid)
+
         announced_fingerprint = self._presence_fingerprint_store.get(jid)
         if announced_fingerprint is None:
             return True
@@ -118,7 +184,11 @@ class PGPLegacy(BaseModule):
             return
         jid = properties.jid.bare
 
-        fingerprint = self._pgp.verify(properties.status, properties.signed)
+        # Verification is deferred, on connect a large roster would
+        # otherwise run hundreds of gpg processes on the main loop
+        self._verification.submit(jid, properties.status, properties.signed)
+
+    def _on_presence_verified(self, jid, fingerprint):
         if fingerprint is None:
             self._log.info('Presence from %s was signed but no corresponding '
                            'key was found', jid)
@@ -140,17 +210,48 @@ class PGPLegacy(BaseModule):
                               fingerprint, key_data['key_id'])
             return
 
-    def _message_received(self, _con, stanza, properties):
+    def _message_received(self, con, stanza, properties):
         if not properties.is_pgp_legacy or properties.from_muc:
             return
 
         from_jid = properties.jid.bare
         self._log.info('Message received from: %s', from_jid)
 
-        payload = self._pgp.decrypt(properties.pgp_legacy)
-        prepare_stanza(stanza, payload)
+        if properties.is_mam_message:
+            # The MAM query result is handed to its IQ callback by nbxmpp
+            # before any stanza handler runs and can not be held back,
+            # Gajim drops archived messages of a finished query. They are
+            # decrypted here, one gpg process per message, python-gnupg
+            # can not decrypt several messages in one invocation.
+            result = self._decryption.decrypt(properties.pgp_legacy)
+            self._on_message_decrypted(result, con, stanza, properties)
+            raise NodeProcessed
+
+        # Decryption happens off the main loop, the remaining handlers
+        # are run once the result is delivered
+        self._decryption.submit(properties.pgp_legacy, con, stanza, properties)
+        raise NodeProcessed
+
+    def _on_message_decrypted(self, result, con, stanza, properties):
+        if con is not self._client.connection:
+            # The stream was closed meanwhile, the message is fetched
+            # again with the MAM catch up after reconnect
+            self._log.info('Connection changed, drop decrypted message')
+            return
+
+        if isinstance(result, Exception):
+            # The message is handled further, so the user sees the
+            # fallback body
+            self._log.error('Error while decrypting message: %s', result)
+        else:
+            prepare_stanza(stanza, result)
+            properties.encrypted = EncryptionData({'name': 'PGP'})
 
-        properties.encrypted = EncryptionData({'name': 'PGP'})
+        resume_handlers(con,
+                        get_message_handlers(self._client),
+                        stanza,
+                        properties,
+                        DECRYPT_PRIORITY)
 
     def encrypt_message(self, con, event, callback):
         if not event.message:
@@ -221,15 +322,88 @@ class PGPLegacy(BaseModule):
             self._log.warning('No own key id found, cant sign presence')
             return
 
-        try:
-            result = self._pgp.sign(status, key_data['key_id'])
-        except SignError as error:
-            self._log.warning('Sign Error: %s', error)
+        key_id = key_data['key_id']
+        if not self._precomputed:
+            # Started with the first presence instead of on module load,
+            # so not all accounts sign at once on startup
+            self._precomputed = True
+            self.precompute_signatures()
+
+        result = self._pgp.get_cached_signature(status, key_id)
+        if result is None:
+            # The hook must not wait for gpg, the presence is sent
+            # unsigned and sent again once the signature is cached
+            self.unsigned_presences += 1
+            self._log.info('No cached signature, presence sent unsigned '
+                           '(%s times)', self.unsigned_presences)
+            request = (key_id, status or '')
+            if request not in self._pending_signatures:
+                self._pending_signatures.add(request)
+                future = get_executor('sign').submit(
+                    self._pgp.sign, status, key_id)
+                future.add_done_callback(
+                    partial(self._on_late_signature, request))
             return
-        # self._log.debug(self._pgp.sign.cache_info())
+
         self._log.info('Presence signed')
         presence.setTag(Namespace.SIGNED + ' x').setData(result)
 
+    def _on_late_signature(self, request, future):
+        # Called on the worker thread
+        GLib.idle_add(self._finish_late_signature, request, future)
+
+    def _finish_late_signature(self, request, future):
+        self._pending_signatures.discard(request)
+        if future.cancelled():
+            return
+
+        error = future.exception()
+        if isinstance(error, SignError):
+            self._log.warning('Sign Error: %s', error)
+            return
+        if error is not None:
+            self._log.error('Error while signing presence: %s', error)
+            return
+
+        _key_id, status = request
+        self._resend_presence(status)
+
+    def _resend_presence(self, status):
+        if not self._client.state.is_available:
+            return
+        if (self._client.status_message or '') != (status or ''):
+            # A newer presence was sent meanwhile
+            return
+        self._log.info('Signature ready, send presence again')
+        self._client.change_status(self._client.status, status)
+
+    def precompute_signatures(self):
+        '''
+        Signs the status presets in the background, so sending a presence
+        with one of them does not wait for gpg
+        '''
+        key_data = self.get_own_key_data()
+        if key_data is None:
+            return
+
+        messages = {''}
+        for preset in app.settings.get_status_presets():
+            settings = app.settings.get_status_preset_settings(preset)
+            messages.add(settings['message'])
+
+        get_executor('precompute').submit(self._sign_in_background,
+                                          key_data['key_id'],
+                                          messages)
+
+    def _sign_in_background(self, key_id, messages):
+        for message in messages:
+            try:
+                self._pgp.sign(message, key_id)
+            except SignError as error:
+                self._log.warning('Sign Error: %s', error)
+                return
+        self._log.info('Precomputed %s presence signatures', len(messages))
+
     @staticmethod
     def _get_info_message():
         msg = '[This message is *encrypted* (See :XEP:`27`)]'
@@ -267,35 +441,116 @@ class PGPLegacy(BaseModule):
         obj.stanza = stanza
 
     def encrypt_file(self, file, callback):
-        thread = threading.Thread(target=self._encrypt_file_thread,
-                                  args=(file, callback))
-        thread.daemon = True
-        thread.start()
-
-    def _encrypt_file_thread(self, file, callback):
+        cancelled = threading.Event()
+        future = get_executor('file-encryption').submit(
+            self._encrypt_file_thread,
+            file,
+            callback,
+            cancelled,
+            time.monotonic())
+        self._file_jobs[cancelled] = future
+        future.add_done_callback(
+            lambda _future: self._file_jobs.pop(cancelled, None))
+
+        def _on_cancel(*args):
+            cancelled.set()
+            if future.cancel():
+                self._log.info('File encryption cancelled before start')
+
+        file.connect('cancel', _on_cancel)
+
+    def _encrypt_file_thread(self, file, callback, cancelled, submitted):
+        started = time.monotonic()
         try:
             key_id, own_key_id = self._get_key_ids(file.contact.jid)
         except NoKeyIdFound as error:
             self._log.warning(error)
             return
 
-        stream = open(file.path, "rb")
-        encrypted = self._pgp.encrypt_file(stream,
-                                           [key_id, own_key_id])
-        stream.close()
+        # gpg writes the encrypted file to disk instead of into memory,
+        # memory use does not depend on the file size
+        with tempfile.NamedTemporaryFile(prefix='gajim-pgp-',
+                                         suffix='.pgp',
+                                         delete=False) as temp_file:
+            temp_path = temp_file.name
+
+        def _on_progress(seen, total):
+            GLib.idle_add(file.update_progress, seen, total)
+
+        with open(file.path, 'rb') as stream:
+            reader = ProgressReader(stream,
+                                    os.path.getsize(file.path),
+                                    _on_progress,
+                                    cancelled)
+            encrypted = self._pgp.encrypt_file(reader,
+                                               [key_id, own_key_id],
+                                               output=temp_path)
+
+        self._log.info('File encryption: queue wait %.2fs, '
+                       'encryption %.2fs', started - submitted,
+                       time.monotonic() - started)
+
+        if cancelled.is_set():
+            self._log.info('File encryption cancelled')
+            self._remove_temp_file(temp_path)
+            return
 
         if not encrypted:
+            self._remove_temp_file(temp_path)
             GLib.idle_add(self._on_file_encryption_error, encrypted.status)
             return
 
-        file.size = len(encrypted.data)
+        # The mapping is backed by the temp file, pages are read on
+        # demand during upload and can be reclaimed by the kernel
+        with open(temp_path, 'rb') as encrypted_file:
+            data = mmap.mmap(encrypted_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+
+        file.size = len(data)
         file.set_uri_transform_func(lambda uri: '%s.pgp' % uri)
-        file.set_encrypted_data(encrypted.data)
-        GLib.idle_add(callback, file)
+        file.set_encrypted_data(data)
+        GLib.idle_add(self._on_file_encrypted, file, callback, data, temp_path)
+
+    def _on_file_encrypted(self, file, callback, data, temp_path):
+        # Windows does not allow removing a mapped file, the mapping and
+        # the temp file are released together once the transfer is done
+        def _release(*args):
+            if data.closed:
+                return
+            try:
+                data.close()
+            except BufferError as error:
+                self._log.warning('Could not close mapped file: %s', error)
+                return
+            self._remove_temp_file(temp_path)
+
+        def _on_state_changed(_file, _signal_name, state):
+            if state.is_finished or state.is_error or state.is_cancelled:
+                _release()
+
+        file.connect('state-changed', _on_state_changed)
+        file.connect('cancel', _release)
+        callback(file)
+
+    def _remove_temp_file(self, path):
+        try:
+            os.unlink(path)
+        except OSError as error:
+            self._log.warning('Could not remove temp file: %s', error)
 
     @staticmethod
     def _on_file_encryption_error(error):
         app.ged.raise_event(PGPFileEncryptionError(error=error))
 
+    def cleanup(self):
+        # Running file encryptions stop with the next read
+        for cancelled, future in list(self._file_jobs.items()):
+            cancelled.set()
+            future.cancel()
+        self._file_jobs.clear()
+        self._decryption.shutdown()
+        self._verification.shutdown()
+        self._store.cleanup()
+
 def get_instance(*args, **kwargs):
     return PGPLegacy(*args, **kwargs), 'PGPLegacy'
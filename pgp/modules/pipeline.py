@@ -0,0 +1,302 @@
+# This file is part of the PGP Gajim Plugin.
+#
+# PGP Gajim Plugin is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation; version 3 only.
+#
+# PGP Gajim Plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import logging
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from gi.repository import GLib
+from nbxmpp.namespaces import Namespace
+from nbxmpp.protocol import NodeProcessed
+
+log = logging.getLogger('gajim.p.pgplegacy.pipeline')
+
+# Throughput of synchronous decryption is logged every n messages
+SYNC_REPORT_INTERVAL = 100
+
+
+def _get_specific(handler):
+    typ = handler.typ
+    if not typ and not handler.ns:
+        typ = 'default'
+    return typ + handler.ns
+
+
+def build_handler_chain(handlers, stanza, priority):
+    '''
+    Builds the chain of handlers the way nbxmpp does, from the properties
+    of the decrypted stanza and only with handlers after the given priority
+    '''
+    xmlns = stanza.getNamespace() or Namespace.CLIENT
+    typ = stanza.getType() or 'normal'
+    props = stanza.getProperties()
+
+    specifics = {'default', typ}
+    for prop in props:
+        specifics.add(prop)
+        specifics.add(typ + prop)
+
+    chain = [handler for handler in handlers
+             if handler.priority > priority and
+             (handler.xmlns or Namespace.CLIENT) == xmlns and
+             _get_specific(handler) in specifics]
+    chain.sort(key=lambda handler: handler.priority)
+    return chain
+
+
+def resume_handlers(con, handlers, stanza, properties, priority):
+    '''
+    Runs the message handlers which come after the handler with the
+    given priority
+    '''
+    for handler in build_handler_chain(handlers, stanza, priority):
+        try:
+            handler.callback(con, stanza, properties)
+        except NodeProcessed:
+            return
+        except Exception:
+            log.exception('Handler exception:')
+            return
+
+
+class DecryptionPipeline:
+    '''
+    Decrypts messages on worker threads and hands the results back to
+    the main loop in the order the messages arrived. decrypt() runs on
+    the calling thread for messages which can not wait.
+    '''
+    def __init__(self, decrypt_func, deliver_func, max_workers=2):
+        self._decrypt_func = decrypt_func
+        self._deliver_func = deliver_func
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='pgp-decrypt')
+
+        self._next_seq = 0
+        self._deliver_seq = 0
+        self._finished = {}
+        self._closed = False
+
+        self.processed = 0
+        self.wait_time = 0.0
+        self.decrypt_time = 0.0
+        self.reorder_time = 0.0
+
+        self.sync_processed = 0
+        self.sync_time = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._next_seq - self._deliver_seq
+
+    def submit(self, ciphertext, *args):
+        seq = self._next_seq
+        self._next_seq += 1
+        future = self._executor.submit(self._run,
+                                       ciphertext,
+                                       time.monotonic())
+        future.add_done_callback(partial(self._on_done, seq, args))
+
+    def decrypt(self, ciphertext):
+        started = time.monotonic()
+        try:
+            result = self._decrypt_func(ciphertext)
+        except Exception as error:
+            result = error
+
+        self.sync_processed += 1
+        self.sync_time += time.monotonic() - started
+        if self.sync_processed % SYNC_REPORT_INTERVAL == 0:
+            log.info('Decrypted %s messages synchronously (%.1f msg/s)',
+                     self.sync_processed, self.sync_rate)
+        return result
+
+    @property
+    def sync_rate(self):
+        return self.sync_processed / (self.sync_time or 1e-6)
+
+    def _run(self, ciphertext, submitted):
+        started = time.monotonic()
+        try:
+            result = self._decrypt_func(ciphertext)
+        except Exception as error:
+            result = error
+        return result, started - submitted, time.monotonic() - started
+
+    def _on_done(self, seq, args, future):
+        # Called on the worker thread
+        if future.cancelled():
+            return
+        GLib.idle_add(self._finish, seq, args, future.result())
+
+    def _finish(self, seq, args, outcome):
+        if self._closed:
+            return False
+
+        result, wait_time, decrypt_time = outcome
+        self.wait_time += wait_time
+        self.decrypt_time += decrypt_time
+        self._finished[seq] = (args, result, time.monotonic())
+
+        while self._deliver_seq in self._finished:
+            args, result, finished = self._finished.pop(self._deliver_seq)
+            self._deliver_seq += 1
+            self.processed += 1
+            self.reorder_time += time.monotonic() - finished
+            try:
+                self._deliver_func(result, *args)
+            except Exception:
+                log.exception('Error while delivering decrypted message')
+
+        log.debug('Queue depth: %s', self.queue_depth)
+        return False
+
+    def get_stats(self):
+        processed = self.processed or 1
+        return {
+            'queue_depth': self.queue_depth,
+            'processed': self.processed,
+            'avg_wait': self.wait_time / processed,
+            'avg_decrypt': self.decrypt_time / processed,
+            'avg_reorder': self.reorder_time / processed,
+            'sync_processed': self.sync_processed,
+            'sync_rate': self.sync_rate,
+        }
+
+    def shutdown(self):
+        self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._finished.clear()
+        log.info('Decryption pipeline stats: %s', self.get_stats())
+
+
+class VerificationQueue:
+    '''
+    Verifies signed presences one at a time in the background, only the
+    latest presence of a contact is verified
+    '''
+    def __init__(self, verify_func, deliver_func, interval=100):
+        self._verify_func = verify_func
+        self._deliver_func = deliver_func
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='pgp-verify')
+
+        self._interval = interval
+        self._pending = OrderedDict()
+        self._running = None
+        self._source_id = None
+        self._closed = False
+
+        self.submitted = 0
+        self.verified = 0
+
+    def submit(self, jid, status, signed):
+        # A newer presence replaces the one still waiting
+        self._pending[jid] = (status, signed)
+        self.submitted += 1
+        self._schedule()
+
+    def wait(self, jid):
+        '''
+        Verifies the presence of the contact immediately if it is still
+        waiting in the queue
+        '''
+        if self._running is not None and self._running[0] == jid:
+            future = self._running[1]
+            self._running = None
+            self._deliver(jid, self._get_result(future))
+            self._schedule()
+
+        item = self._pending.pop(jid, None)
+        if item is None:
+            return
+
+        try:
+            fingerprint = self._verify_func(*item, jid=jid)
+        except Exception:
+            log.exception('Error while verifying presence')
+            fingerprint = None
+        self._deliver(jid, fingerprint)
+
+    def _schedule(self):
+        if self._closed or self._running is not None:
+            return
+
+        if self._source_id is not None or not self._pending:
+            return
+
+        self._source_id = GLib.timeout_add(self._interval, self._start_next)
+
+    def _start_next(self):
+        self._source_id = None
+        if self._closed or not self._pending:
+            return False
+
+        jid, (status, signed) = self._pending.popitem(last=False)
+        future = self._executor.submit(self._verify_func,
+                                       status,
+                                       signed,
+                                       jid=jid)
+        self._running = (jid, future)
+        future.add_done_callback(self._on_done)
+        return False
+
+    def _on_done(self, future):
+        # Called on the worker thread
+        if future.cancelled():
+            return
+        GLib.idle_add(self._finish, future)
+
+    def _finish(self, future):
+        if self._closed:
+            return False
+
+        if self._running is None or self._running[1] is not future:
+            # Result was already delivered by wait()
+            return False
+
+        jid = self._running[0]
+        self._running = None
+        self._deliver(jid, self._get_result(future))
+        self._schedule()
+        return False
+
+    @staticmethod
+    def _get_result(future):
+        try:
+            return future.result()
+        except Exception:
+            log.exception('Error while verifying presence')
+            return None
+
+    def _deliver(self, jid, fingerprint):
+        self.verified += 1
+        try:
+            self._deliver_func(jid, fingerprint)
+        except Exception:
+            log.exception('Error while delivering verified presence')
+
+    def shutdown(self):
+        self._closed = True
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+        self._pending.clear()
+        self._running = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        log.info('Presence verification: %s submitted, %s verified',
+                 self.submitted, self.verified)
@@ -15,10 +15,34 @@
 # along with PGP Gajim Plugin. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import time
 import subprocess
 
 from nbxmpp.namespaces import Namespace
 
+from gajim.common import modules
+
+# nbxmpp modules which parse properties of a message stanza, they
+# have to see the decrypted content
+NBXMPP_MESSAGE_MODULES = (
+    'BaseMessage',
+    'MUC',
+    'Attention',
+    'ChatMarkers',
+    'Chatstates',
+    'Correction',
+    'Delay',
+    'EME',
+    'OOB',
+    'Receipts',
+    'Reactions',
+    'Replies',
+    'SecurityLabels',
+    'HTTPAuth',
+    'Captcha',
+    'Nickname',
+)
+
 
 def prepare_stanza(stanza, plaintext):
     delete_nodes(stanza, 'encrypted', Namespace.ENCRYPTED)
@@ -47,3 +71,46 @@ def find_gpg():
 
     if _search('gpg'):
         return 'gpg'
+
+
+class ProgressReader:
+    '''
+    Wraps a file object and reports how many bytes were read,
+    at most every interval seconds. Reading fails once cancelled is set.
+    '''
+    def __init__(self, stream, total, callback, cancelled, interval=0.2):
+        self._stream = stream
+        self._total = total
+        self._callback = callback
+        self._cancelled = cancelled
+        self._interval = interval
+        self._seen = 0
+        self._last_report = 0
+
+    def read(self, size=-1):
+        if self._cancelled.is_set():
+            raise OSError('Read cancelled')
+
+        data = self._stream.read(size)
+        self._seen += len(data)
+        now = time.monotonic()
+        if not data or now - self._last_report >= self._interval:
+            self._last_report = now
+            self._callback(self._seen, self._total)
+        return data
+
+
+def get_message_handlers(client):
+    '''
+    Collects the message handlers of the nbxmpp and Gajim modules
+    of the client
+    '''
+    handlers = list(modules.get_handlers(client))
+    for name in NBXMPP_MESSAGE_MODULES:
+        try:
+            module = client.connection.get_module(name)
+        except KeyError:
+            # Not available in this nbxmpp version
+            continue
+        handlers += module.handlers
+    return [handler for handler in handlers if handler.name == 'message']
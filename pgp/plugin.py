@@ -39,10 +39,15 @@ ENCRYPTION_NAME = 'PGP'
 log = logging.getLogger('gajim.p.pgplegacy')
 
 ERROR = False
+try:
+    import gpg
+except ImportError:
+    gpg = None
+
 try:
     import gnupg
 except ImportError:
-    ERROR = True
+    ERROR = gpg is None
 else:
     # We need https://pypi.python.org/pypi/python-gnupg
     # but https://pypi.python.org/pypi/gnupg shares the same package name.
@@ -53,7 +58,7 @@ else:
     v_gnupg = gnupg.__version__
     if V(v_gnupg) < V('0.3.8') or V(v_gnupg) > V('1.0.0'):
         log.error('We need python-gnupg >= 0.3.8')
-        ERROR = True
+        ERROR = gpg is None
 
 ERROR_MSG = None
 BINARY = find_gpg()
@@ -66,7 +71,8 @@ if BINARY is None or ERROR:
         ERROR_MSG = _('Please install python-gnupg and gnupg')
 else:
     from pgp.modules import pgp_legacy
-    from pgp.backend.python_gnupg import PGP
+    from pgp.modules.pgp_legacy import PGP
+    log.info('Using backend: %s', PGP.__module__)
 
 
 class PGPPlugin(GajimPlugin):
@@ -74,6 +80,14 @@ class PGPPlugin(GajimPlugin):
     def init(self):
         # pylint: disable=attribute-defined-outside-init
         self.description = _('PGP encryption as per XEP-0027')
+        self.config_default_values = {
+            'sign_cache_size': (
+                32,
+                'Number of presence signatures cached per key'),
+            'sign_cache_ttl': (
+                3600,
+                'Seconds a cached presence signature is reused'),
+        }
         if ERROR_MSG:
             self.activatable = False
             self.config_dialog = None
@@ -110,10 +124,11 @@ class PGPPlugin(GajimPlugin):
         return app.get_client(account).get_module('PGPLegacy')
 
     def activate(self):
-        pass
+        self._pgp.sign_cache.configure(self.config['sign_cache_size'],
+                                       self.config['sign_cache_ttl'])
 
     def deactivate(self):
-        pass
+        pgp_legacy.shutdown_executors()
 
     @staticmethod
     def activate_encryption(_chat_control):
@@ -0,0 +1,73 @@
+import unittest
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+try:
+    from openpgp.backend.gpgme import GPGME
+    from openpgp.modules.util import DecryptionFailed
+except ImportError:
+    # The gpg bindings and Gajim are needed to import the backend
+    GPGME = None
+
+
+FINGERPRINT = 'A' * 40
+
+
+class StubContext:
+    def __init__(self, plaintext=b'', fingerprints=(), error=None):
+        self._plaintext = plaintext
+        self._fingerprints = fingerprints
+        self._error = error
+        self.ciphertext = None
+
+    def decrypt(self, ciphertext):
+        self.ciphertext = ciphertext
+        if self._error is not None:
+            raise self._error
+
+        signatures = [SimpleNamespace(fpr=fingerprint)
+                      for fingerprint in self._fingerprints]
+        return self._plaintext, None, SimpleNamespace(signatures=signatures)
+
+
+class StubPool:
+    def __init__(self, context):
+        self._context = context
+
+    @contextmanager
+    def context(self):
+        yield self._context
+
+
+@unittest.skipIf(GPGME is None, 'gpg bindings or Gajim not available')
+class TestDecrypt(unittest.TestCase):
+    @staticmethod
+    def _create_backend(context):
+        backend = GPGME.__new__(GPGME)
+        backend._pool = StubPool(context)
+        return backend
+
+    def test_decrypt(self):
+        context = StubContext(b'Hello', [FINGERPRINT])
+        backend = self._create_backend(context)
+
+        self.assertEqual(backend.decrypt(b'ciphertext'),
+                         ('Hello', FINGERPRINT))
+        self.assertEqual(context.ciphertext, b'ciphertext')
+
+    def test_decrypt_not_signed(self):
+        for fingerprints in ([], [FINGERPRINT, 'B' * 40]):
+            backend = self._create_backend(
+                StubContext(b'Hello', fingerprints))
+            with self.assertRaises(DecryptionFailed):
+                backend.decrypt(b'ciphertext')
+
+    def test_decrypt_error(self):
+        backend = self._create_backend(
+            StubContext(error=ValueError('No secret key')))
+        with self.assertRaises(DecryptionFailed):
+            backend.decrypt(b'ciphertext')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import tempfile
+import threading
+import unittest
+import importlib.util
+from pathlib import Path
+
+
+def load_util():
+    # Import the module directly, the plugin package pulls in Gtk
+    path = Path(__file__).parent.parent / 'openpgp' / 'backend' / 'util.py'
+    spec = importlib.util.spec_from_file_location('openpgp_util', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+util = load_util()
+
+ALICE = 'A' * 40
+BOB = 'B' * 40
+INVALID = 'C' * 40
+
+
+class TestScanKeyring(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = util.KeyringIndex(Path(directory.name) / 'index.json')
+
+        self.keyring = [(ALICE, ['xmpp:alice@example.org']),
+                        (BOB, ['xmpp:bob@example.org']),
+                        (INVALID, ['Carol <carol@example.org>'])]
+        self.listed = 0
+        self.deleted = []
+        self.delete_done = threading.Event()
+
+    def _list_keys(self):
+        self.listed += 1
+        return list(self.keyring)
+
+    def _delete_key(self, fingerprint):
+        self.deleted.append(fingerprint)
+        self.delete_done.set()
+
+    def _scan(self, mtime, index=True):
+        keys = util.scan_keyring(self._list_keys,
+                                 self._delete_key,
+                                 self.index if index else None,
+                                 mtime)
+        return {key.fingerprint: key.uid for key in keys}
+
+    def test_scan(self):
+        keys = self._scan(1)
+        self.assertEqual(keys, {ALICE: 'alice@example.org',
+                                BOB: 'bob@example.org'})
+        self.assertTrue(self.delete_done.wait(5))
+        self.assertEqual(self.deleted, [INVALID])
+
+        # The index is used as long as the keyring does not change
+        self.assertEqual(self._scan(1), keys)
+        self.assertEqual(self.listed, 1)
+
+    def test_rescan(self):
+        self._scan(1)
+        self.keyring = [(ALICE, ['xmpp:alice@example.net']),
+                        (BOB, ['xmpp:bob@example.org'])]
+        keys = self._scan(2)
+        self.assertEqual(keys, {ALICE: 'alice@example.net',
+                                BOB: 'bob@example.org'})
+        self.assertEqual(self.index.mtime, 2)
+
+    def test_without_index(self):
+        self._scan(1, index=False)
+        self._scan(1, index=False)
+        self.assertEqual(self.listed, 2)
+        self.assertIsNone(self.index.mtime)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+import importlib.util
+from pathlib import Path
+
+from nbxmpp.namespaces import Namespace
+from nbxmpp.protocol import Message
+from nbxmpp.protocol import NodeProcessed
+from nbxmpp.structs import StanzaHandler
+
+
+def load_pipeline(plugin):
+    # Import the module directly, the plugin package pulls in Gtk
+    path = Path(__file__).parent.parent / plugin / 'modules' / 'pipeline.py'
+    spec = importlib.util.spec_from_file_location(
+        '%s_pipeline' % plugin, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestResumeHandlers(unittest.TestCase):
+    pipeline = load_pipeline('openpgp')
+    encrypted = ('openpgp', Namespace.OPENPGP)
+
+    def setUp(self):
+        self.called = []
+        self.con = object()
+        self.properties = object()
+
+        self.stanza = Message(to='alice@example.org', typ='chat')
+        name, namespace = self.encrypted
+        self.stanza.addChild(name, namespace=namespace)
+
+    def _handler(self, priority, typ='', ns='', exception=None):
+        def _callback(con, stanza, properties):
+            self.assertIs(con, self.con)
+            self.assertIs(stanza, self.stanza)
+            self.assertIs(properties, self.properties)
+            self.called.append(priority)
+            if exception is not None:
+                raise exception
+
+        return StanzaHandler(name='message',
+                             callback=_callback,
+                             typ=typ,
+                             ns=ns,
+                             priority=priority)
+
+    def _decrypt(self):
+        self.stanza.delChild(self.encrypted[0])
+        self.stanza.setBody('Hello')
+        self.stanza.addChild('active', namespace=Namespace.CHATSTATES)
+
+    def test_chain(self):
+        handlers = [
+            self._handler(30),
+            self._handler(5),
+            self._handler(9, ns=self.encrypted[1]),
+            self._handler(15, ns=Namespace.CHATSTATES),
+            self._handler(12, typ='chat'),
+            self._handler(13, typ='groupchat'),
+            self._handler(14, ns=Namespace.RECEIPTS),
+            self._handler(10),
+        ]
+        self._decrypt()
+
+        self.pipeline.resume_handlers(
+            self.con, handlers, self.stanza, self.properties, 9)
+
+        # Handlers up to the decryption handler already ran, the chatstate
+        # handler only matches the decrypted stanza
+        self.assertEqual(self.called, [10, 12, 15, 30])
+
+    def test_chain_stops(self):
+        handlers = [
+            self._handler(10),
+            self._handler(20, exception=NodeProcessed),
+            self._handler(25),
+        ]
+        self.pipeline.resume_handlers(
+            self.con, handlers, self.stanza, self.properties, 9)
+        self.assertEqual(self.called, [10, 20])
+
+        self.called.clear()
+        handlers[1] = self._handler(20, exception=ValueError)
+        self.pipeline.resume_handlers(
+            self.con, handlers, self.stanza, self.properties, 9)
+        self.assertEqual(self.called, [10, 20])
+
+
+class TestDecryptionPipeline(unittest.TestCase):
+    pipeline = load_pipeline('openpgp')
+
+    @staticmethod
+    def _decrypt(ciphertext):
+        if ciphertext == 'broken':
+            raise ValueError('Decryption failed')
+        return ciphertext.upper()
+
+    def test_decrypt(self):
+        decryption = self.pipeline.DecryptionPipeline(self._decrypt, None)
+        self.addCleanup(decryption.shutdown)
+
+        self.assertEqual(decryption.decrypt('hello'), 'HELLO')
+        result = decryption.decrypt('broken')
+        self.assertIsInstance(result, ValueError)
+
+        stats = decryption.get_stats()
+        self.assertEqual(stats['sync_processed'], 2)
+        self.assertGreater(stats['sync_rate'], 0)
+        self.assertEqual(stats['queue_depth'], 0)
+
+
+class TestLegacyResumeHandlers(TestResumeHandlers):
+    pipeline = load_pipeline('pgp')
+    encrypted = ('x', Namespace.ENCRYPTED)
+
+
+class TestLegacyDecryptionPipeline(TestDecryptionPipeline):
+    pipeline = load_pipeline('pgp')
+
+
+if __name__ == '__main__':
+    unittest.main()